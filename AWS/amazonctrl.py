@@ -71,16 +71,787 @@ extremely helpful. Boto3's documentation is outstanding..
 
 """
 
+import base64
+import collections
+import contextlib
+import copy
+import functools
+import hashlib
+import inspect
+import itertools
 import json
+import os
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-import boto3
 import click
 
 
-def get_client(service):
-    """Get an AWS client for a service."""
-    session = boto3.Session()
-    return session.client(service)
+MAX_POOL_CONNECTIONS = 10
+BATCH_WORKERS = 4
+ECS_BATCH_SIZE = 100
+ECS_SERVICE_BATCH_SIZE = 10
+PART_SIZE = 64 * 1024 * 1024
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PARTS = 10000
+UPLOAD_WORKERS = 4
+WAIT_DELAY = 2
+WAIT_MAX_DELAY = 30
+WAIT_TIMEOUT = 30 * 60
+ASG_BATCH_SIZE = 50
+STACK_LOOKUPS = 10
+INSTANCE_BATCH_SIZE = 1000
+CACHE_TTL = 60
+CACHE_TTLS = {}
+CACHE_SIZE = 1000
+CACHED_VERBS = ("Describe", "List")
+CACHE_INVALIDATES = {
+    "AttachInstances": ("Auto",),
+    "DetachInstances": ("Auto",),
+    "AttachLoadBalancers": ("Auto",),
+    "DetachLoadBalancers": ("Auto",),
+    "AttachLoadBalancerTargetGroups": ("Auto",),
+    "DetachLoadBalancerTargetGroups": ("Auto",),
+    "RunTask": ("Container", "Service", "Cluster"),
+    "StopTask": ("Container", "Service", "Cluster"),
+    "CreateService": ("Cluster",),
+    "DeleteService": ("Cluster",),
+    "UploadPart": ("Multipart", "Part"),
+    }
+READ_VERBS = ("Describe", "List", "Get", "Head")
+PROTOCOL_NAMES = {"6": "tcp", "17": "udp", "1": "icmp", "all": "-1"}
+DEFAULT_ACL_RULE = 32767
+ICMP_PROTOCOLS = ("1", "58")
+METRICS_SIZE = 100000
+FAN_OUT_WORKERS = 16
+ROLE_SESSION_NAME = "amazonctl"
+THROTTLE_CODES = {
+    "Throttling", "ThrottlingException", "ThrottledException",
+    "RequestThrottledException", "TooManyRequestsException",
+    "ProvisionedThroughputExceededException", "RequestLimitExceeded",
+    "BandwidthLimitExceeded", "LimitExceededException", "RequestThrottled",
+    "SlowDown", "PriorRequestNotComplete", "EC2ThrottledException",
+    }
+METRICS_HEADER = ("{:<16} {:<34} {:>6} {:>6} {:>7} {:>9} {:>6} {:>9} "
+                  "{:>9} {:>11}")
+METRICS_ROW = ("{:<16} {:<34} {:>6} {:>6} {:>7} {:>9} {:>6} {:>9.3f} "
+               "{:>9.1f} {:>11}")
+METRICS_TITLES = ("service", "operation", "calls", "errors", "retries",
+                  "throttles", "cached", "seconds", "max ms", "bytes")
+PROMETHEUS_METRICS = (
+    ("calls_total", "counter", "AWS API calls made.", "calls"),
+    ("errors_total", "counter", "AWS API calls that failed.", "errors"),
+    ("retries_total", "counter", "Retried attempts of AWS API calls.",
+     "retries"),
+    ("throttles_total", "counter", "Throttled attempts of AWS API calls.",
+     "throttles"),
+    ("cached_total", "counter", "AWS API calls answered from the cache.",
+     "cached"),
+    ("response_bytes_total", "counter", "Bytes of AWS API responses.",
+     "bytes"),
+    ("call_seconds_total", "counter", "Seconds spent in AWS API calls.",
+     "seconds"),
+    )
+
+_sessions = {}
+_clients = {}
+_clients_lock = threading.Lock()
+_accounts = {}
+_subjects = {}
+_cache = None
+_cache_lock = threading.Lock()
+_metrics = None
+_metrics_lock = threading.Lock()
+_target = threading.local()
+_fresh = threading.local()
+
+
+
+"""#########################################################################
+
+Clients
+-------
+
+Every function below gets its client from ``get_client()``, which builds
+one client per profile, region, and service and then keeps reusing it, so
+repeated calls skip the session setup, the endpoint lookup, and the TLS
+handshake. Clients are safe to share between threads. boto3 itself isn't
+imported until the first client is needed.
+
+To get a client for a particular profile or region::
+
+    >>> amazonctl.get_client("ec2", profile="prod", region="eu-west-1")
+
+To let each client keep more connections open, e.g. when calling it from
+many threads at once::
+
+    >>> amazonctl.configure_clients(max_pool_connections=50)
+
+After rotating credentials, drop the cached clients so the next call
+builds new ones with fresh credentials::
+
+    >>> amazonctl.invalidate_clients()
+
+Or drop only some of them::
+
+    >>> amazonctl.invalidate_clients(profile="prod")
+
+The ``get_*`` functions return AWS's raw response, which holds only the
+first page of results. Each has an ``iter_*`` twin that yields the items
+one at a time, fetching the next page only when it's needed::
+
+    >>> for vpc in amazonctl.iter_vpcs():
+    ...     print(vpc["VpcId"])
+
+To ask for smaller or bigger pages, or to stop after some items::
+
+    >>> amazonctl.iter_task_arns("my-cluster", page_size=50, max_items=500)
+
+When exploring, the same ``get_*`` calls tend to get made over and over.
+To keep their responses for a while instead of asking AWS every time::
+
+    >>> amazonctl.enable_cache(ttl=120)
+
+Responses are kept per account, region, operation, and parameters, for
+``ttl`` seconds or for as long as set per operation::
+
+    >>> amazonctl.enable_cache(ttls={"DescribeStacks": 10})
+
+Calls that change something drop the responses they make stale, so
+``create_subnet()`` makes the next ``get_subnets()`` ask AWS again.
+Changes that show up in another resource's description, such as
+``attach_load_balancer()`` in ``get_auto_scaling_groups()``, are listed
+in ``CACHE_INVALIDATES``; a change to something no cached call reads
+drops every response of its service.
+
+The ``wait_for_*`` and ``apply_*`` functions always ask AWS, since they
+need the current state. To do the same in your own code::
+
+    >>> with amazonctl.fresh_reads():
+    ...     amazonctl.get_stacks()
+
+To drop everything by hand, or to stop caching::
+
+    >>> amazonctl.clear_cache()
+    >>> amazonctl.disable_cache()
+
+To find out where the time goes, record every call's operation, latency,
+retries, throttled attempts, and response size::
+
+    >>> amazonctl.enable_metrics()
+
+Then, after running some functions, sum them up per operation::
+
+    >>> print(amazonctl.format_metrics_table())
+
+Or hand them to Prometheus, or keep every call in a JSON Lines file::
+
+    >>> print(amazonctl.format_metrics_prometheus())
+    >>> amazonctl.write_metrics_trace("calls.jsonl")
+
+To point the functions at another region or account for a while::
+
+    >>> with amazonctl.target(region="eu-west-1"):
+    ...     amazonctl.get_stacks()
+
+To run one or more functions in many regions and accounts at once::
+
+    >>> regions = [x["RegionName"] for x in amazonctl.get_regions()["Regions"]]
+    >>> roles = ["arn:aws:iam::111111111111:role/Audit",
+    ...          "arn:aws:iam::222222222222:role/Audit"]
+    >>> amazonctl.fan_out(amazonctl.get_auto_scaling_groups, regions, roles)
+
+Each item of the returned list says which "account", "region", and
+"function" it's about, and holds either its "result" or its "error".
+To pass arguments, or to run several functions::
+
+    >>> amazonctl.fan_out([amazonctl.iter_task_arns,
+    ...     amazonctl.iter_service_arns], regions, args=["my-cluster"])
+
+"""
+
+
+def get_client(service, profile=None, region=None, role=None):
+    """Get a cached AWS client for a service.
+
+    Whatever isn't given comes from the surrounding ``target()``, if any.
+
+    """
+    if profile is None:
+        profile = getattr(_target, "profile", None)
+    if region is None:
+        region = getattr(_target, "region", None)
+    if role is None:
+        role = getattr(_target, "role", None)
+    key = (profile, region, service, role)
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                from botocore.config import Config
+                session = _sessions.get((profile, role))
+                if session is None:
+                    session = make_session(profile, role)
+                    _sessions[(profile, role)] = session
+                params = {}
+                params["region_name"] = region
+                params["config"] = Config(
+                    max_pool_connections=MAX_POOL_CONNECTIONS)
+                client = session.client(service, **params)
+                watch_calls(client)
+                watch_cache(client, profile, role)
+                _clients[key] = client
+    return client
+
+
+def make_session(profile=None, role=None):
+    """Make a session for a profile, or for a role assumed from it.
+
+    A role's credentials are fetched when first needed and fetched again
+    before they expire.
+
+    """
+    import boto3
+    import botocore.session
+    from botocore.credentials import (AssumeRoleCredentialFetcher,
+                                      CredentialProvider,
+                                      DeferredRefreshableCredentials)
+    core = botocore.session.Session(profile=profile)
+    if role is not None:
+        source = botocore.session.Session(profile=profile)
+        params = {}
+        params["RoleSessionName"] = ROLE_SESSION_NAME
+        fetcher = AssumeRoleCredentialFetcher(
+            source.create_client, source.get_credentials(), role,
+            extra_args=params)
+
+        class AssumedRole(CredentialProvider):
+            METHOD = "assume-role"
+            CANONICAL_NAME = "amazonctl-assume-role"
+
+            def load(self):
+                return DeferredRefreshableCredentials(
+                    fetcher.fetch_credentials, self.METHOD)
+
+        resolver = core.get_component("credential_provider")
+        resolver.providers.insert(0, AssumedRole())
+    return boto3.Session(botocore_session=core)
+
+
+@contextlib.contextmanager
+def target(region=None, role=None, profile=None):
+    """Point the functions called inside at another region or account.
+
+    What isn't given is kept from the surrounding ``target()``, if any.
+
+    """
+    saved = dict(vars(_target))
+    if region is not None:
+        _target.region = region
+    if role is not None:
+        _target.role = role
+    if profile is not None:
+        _target.profile = profile
+    try:
+        yield
+    finally:
+        vars(_target).clear()
+        vars(_target).update(saved)
+
+
+def fan_out(functions, regions=None, roles=None, args=(), kwargs=None,
+            profile=None, workers=FAN_OUT_WORKERS):
+    """Run functions in every region of every account, several at once.
+
+    ``functions`` is one function or a list of them, each called with
+    ``args`` and ``kwargs``. ``roles`` are the ARNs of roles to assume,
+    one per account; without them the profile's own account is used.
+    Without ``regions``, the profile's default region is. Each run's
+    result, or its error, is tagged with its account and region, and one
+    failing doesn't stop the others.
+
+    """
+    if callable(functions):
+        functions = [functions]
+    jobs = list(itertools.product(roles or [None], regions or [None],
+                                  functions))
+
+    def run(job):
+        role, region, function = job
+        outcome = {}
+        outcome["account"] = None
+        outcome["region"] = region
+        outcome["function"] = function.__name__
+        outcome["result"] = None
+        outcome["error"] = None
+        try:
+            with target(region, role, profile):
+                outcome["account"] = get_account(profile, role)
+                if region is None:
+                    client = get_client("sts")
+                    outcome["region"] = client.meta.region_name
+                result = function(*args, **(kwargs or {}))
+                if inspect.isgenerator(result):
+                    result = list(result)
+                outcome["result"] = result
+        except Exception as error:
+            outcome["error"] = "%s: %s" % (type(error).__name__, error)
+        return outcome
+
+    with ThreadPoolExecutor(workers) as pool:
+        return list(pool.map(run, jobs))
+
+
+def configure_clients(max_pool_connections=None):
+    """Change how new clients are built and drop the cached ones."""
+    global MAX_POOL_CONNECTIONS
+    if max_pool_connections is not None:
+        MAX_POOL_CONNECTIONS = max_pool_connections
+    invalidate_clients()
+
+
+def invalidate_clients(profile=None, region=None, service=None, role=None):
+    """Drop the cached clients that match, or all of them.
+
+    Sessions are dropped too unless a region or service narrows it down,
+    so their credentials are loaded again.
+
+    """
+    wanted = (profile, region, service, role)
+    with _clients_lock:
+        for key in list(_clients):
+            if all(want is None or want == have
+                   for want, have in zip(wanted, key)):
+                del _clients[key]
+        if region is None and service is None:
+            for key in list(_sessions):
+                if all(want is None or want == have
+                       for want, have in zip((profile, role), key)):
+                    del _sessions[key]
+                    _accounts.pop(key[0], None)
+
+
+def enable_cache(ttl=None, size=None, ttls=None):
+    """Start caching the responses of describe and list calls.
+
+    ``ttl`` is how many seconds a response is kept, ``ttls`` overrides it
+    per operation, and ``size`` caps how many responses are kept.
+
+    """
+    global _cache, CACHE_TTL, CACHE_SIZE
+    if ttl is not None:
+        CACHE_TTL = ttl
+    if size is not None:
+        CACHE_SIZE = size
+    if ttls:
+        CACHE_TTLS.update(ttls)
+    with _cache_lock:
+        if _cache is None:
+            _cache = collections.OrderedDict()
+
+
+def disable_cache():
+    """Stop caching responses and drop the ones kept."""
+    global _cache
+    with _cache_lock:
+        _cache = None
+
+
+def clear_cache():
+    """Drop every cached response."""
+    with _cache_lock:
+        if _cache is not None:
+            _cache.clear()
+
+
+@contextlib.contextmanager
+def fresh_reads(on=True):
+    """Make the calls inside go to AWS even if a response is cached.
+
+    Their responses still replace the cached ones.
+
+    """
+    saved = getattr(_fresh, "on", False)
+    _fresh.on = on
+    try:
+        yield
+    finally:
+        _fresh.on = saved
+
+
+def watch_cache(client, profile, role=None):
+    """Route a client's calls through the response cache."""
+    events = client.meta.events
+    events.register("before-parameter-build",
+                    functools.partial(mark_cached_call, profile, role))
+    events.register("before-call", serve_cached_call)
+    events.register("after-call", store_cached_call)
+
+
+def split_operation(operation):
+    """Split an operation name into its verb and the resource it's about."""
+    words = re.findall(r"[A-Z][a-z0-9]*", operation) + [""]
+    return words[0], words[1].rstrip("s")
+
+
+def get_cached_subjects(service_model):
+    """Get the resources a service's cached calls are about."""
+    service = service_model.service_name
+    if service not in _subjects:
+        _subjects[service] = {
+            subject for verb, subject in
+            map(split_operation, service_model.operation_names)
+            if verb in CACHED_VERBS}
+    return _subjects[service]
+
+
+def get_account(profile=None, role=None):
+    """Get the account ID a profile's credentials, or a role, belong to."""
+    if role is not None:
+        return role.split(":")[4]
+    account = _accounts.get(profile)
+    if account is None:
+        try:
+            client = get_client("sts", profile, role=role)
+            account = client.get_caller_identity()["Account"]
+        except Exception:
+            account = profile or ""
+        _accounts[profile] = account
+    return account
+
+
+def mark_cached_call(profile, role, params, model, context, **kwargs):
+    """Note which cached response a call reads, or which ones it changes."""
+    if _cache is None:
+        return
+    verb, subject = split_operation(model.name)
+    if verb in READ_VERBS and verb not in CACHED_VERBS:
+        return
+    account = get_account(profile, role)
+    service = model.service_model.service_name
+    scope = (account, context["client_region"], service)
+    if verb in CACHED_VERBS:
+        body = json.dumps(params, sort_keys=True, default=str)
+        context["cache_key"] = scope + (model.name, body)
+    else:
+        subjects = (subject,) + CACHE_INVALIDATES.get(model.name, ())
+        if not get_cached_subjects(model.service_model) & set(subjects):
+            subjects = None
+        context["cache_scope"] = scope + (subjects,)
+
+
+def serve_cached_call(context, **kwargs):
+    """Answer a call from the cache if a fresh response is kept."""
+    key = context.get("cache_key")
+    if key is None or getattr(_fresh, "on", False):
+        return None
+    with _cache_lock:
+        entry = _cache.get(key) if _cache is not None else None
+        if entry is None:
+            return None
+        expires, http_response, parsed = entry
+        if expires < time.monotonic():
+            del _cache[key]
+            return None
+        _cache.move_to_end(key)
+    context["cache_hit"] = True
+    return http_response, copy.deepcopy(parsed)
+
+
+def store_cached_call(http_response, parsed, model, context, **kwargs):
+    """Keep a call's response, or drop the ones it made stale."""
+    key = context.get("cache_key")
+    scope = context.get("cache_scope")
+    with _cache_lock:
+        if _cache is None:
+            return
+        if scope:
+            for cached in list(_cache):
+                if cached[:3] == scope[:3] and (
+                        scope[3] is None
+                        or split_operation(cached[3])[1] in scope[3]):
+                    del _cache[cached]
+        if key is None or context.get("cache_hit"):
+            return
+        if http_response.status_code >= 300:
+            return
+        expires = time.monotonic() + CACHE_TTLS.get(model.name, CACHE_TTL)
+        _cache[key] = (expires, http_response, copy.deepcopy(parsed))
+        _cache.move_to_end(key)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+def enable_metrics():
+    """Start recording how each AWS call goes."""
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = collections.deque(maxlen=METRICS_SIZE)
+
+
+def disable_metrics():
+    """Stop recording calls and drop the records kept."""
+    global _metrics
+    with _metrics_lock:
+        _metrics = None
+
+
+def clear_metrics():
+    """Drop the records kept."""
+    with _metrics_lock:
+        if _metrics is not None:
+            _metrics.clear()
+
+
+def get_metrics():
+    """List the record of each call made since recording started."""
+    with _metrics_lock:
+        return list(_metrics or [])
+
+
+def watch_calls(client):
+    """Record how a client's calls go while metrics are enabled."""
+    events = client.meta.events
+    events.register("before-parameter-build", start_call)
+    events.register("needs-retry", count_attempt)
+    events.register("after-call", record_call)
+    events.register("after-call-error", record_failed_call)
+
+
+def start_call(model, context, **kwargs):
+    """Note which call is starting and when."""
+    if _metrics is not None:
+        context["service"] = model.service_model.service_name
+        context["operation"] = model.name
+        context["started"] = time.perf_counter()
+
+
+def count_attempt(request_dict, attempts, response, **kwargs):
+    """Count a call's attempts and how many of them were throttled."""
+    context = request_dict.get("context", {})
+    if "started" not in context:
+        return
+    context["attempts"] = attempts
+    if response is not None:
+        code = response[1].get("Error", {}).get("Code")
+        if code in THROTTLE_CODES:
+            context["throttles"] = context.get("throttles", 0) + 1
+
+
+def record_call(http_response, parsed, model, context, **kwargs):
+    """Record a call that got a response."""
+    if "started" not in context:
+        return
+    cached = bool(context.get("cache_hit"))
+    size = 0
+    if not cached:
+        size = http_response.headers.get("content-length")
+        if size is None and not model.has_streaming_output:
+            size = len(http_response.content or b"")
+    record = new_record(context)
+    record["status"] = http_response.status_code
+    record["bytes"] = int(size or 0)
+    record["cached"] = cached
+    if http_response.status_code >= 300:
+        record["error"] = parsed.get("Error", {}).get("Code")
+    keep_record(record)
+
+
+def record_failed_call(exception, context, **kwargs):
+    """Record a call that failed without a response."""
+    if "started" not in context:
+        return
+    record = new_record(context)
+    record["error"] = type(exception).__name__
+    keep_record(record)
+
+
+def new_record(context):
+    """Start the record of a finished call."""
+    record = {}
+    record["time"] = time.time()
+    record["service"] = context["service"]
+    record["region"] = context.get("client_region")
+    record["operation"] = context["operation"]
+    record["seconds"] = time.perf_counter() - context["started"]
+    record["retries"] = max(context.get("attempts", 1) - 1, 0)
+    record["throttles"] = context.get("throttles", 0)
+    record["status"] = None
+    record["bytes"] = 0
+    record["cached"] = False
+    record["error"] = None
+    return record
+
+
+def keep_record(record):
+    """Add a record to the ones kept."""
+    with _metrics_lock:
+        if _metrics is not None:
+            _metrics.append(record)
+
+
+def summarize_metrics():
+    """Sum up the recorded calls per operation, slowest first."""
+    rows = {}
+    for record in get_metrics():
+        key = (record["service"], record["operation"])
+        if key not in rows:
+            rows[key] = {
+                "service": record["service"],
+                "operation": record["operation"],
+                "calls": 0,
+                "errors": 0,
+                "retries": 0,
+                "throttles": 0,
+                "cached": 0,
+                "seconds": 0.0,
+                "max_seconds": 0.0,
+                "bytes": 0,
+                }
+        row = rows[key]
+        row["calls"] += 1
+        row["errors"] += record["error"] is not None
+        row["retries"] += record["retries"]
+        row["throttles"] += record["throttles"]
+        row["cached"] += record["cached"]
+        row["seconds"] += record["seconds"]
+        row["max_seconds"] = max(row["max_seconds"], record["seconds"])
+        row["bytes"] += record["bytes"]
+    return sorted(rows.values(), key=lambda x: x["seconds"], reverse=True)
+
+
+def format_metrics_table():
+    """Lay out the summary of the recorded calls as a table."""
+    lines = [METRICS_HEADER.format(*METRICS_TITLES)]
+    for row in summarize_metrics():
+        lines.append(METRICS_ROW.format(
+            row["service"], row["operation"], row["calls"], row["errors"],
+            row["retries"], row["throttles"], row["cached"], row["seconds"],
+            row["max_seconds"] * 1000, row["bytes"]))
+    return "\n".join(lines)
+
+
+def format_metrics_prometheus():
+    """Lay out the summary of the recorded calls in Prometheus' format."""
+    rows = summarize_metrics()
+    lines = []
+    for name, kind, text, field in PROMETHEUS_METRICS:
+        lines.append("# HELP amazonctl_%s %s" % (name, text))
+        lines.append("# TYPE amazonctl_%s %s" % (name, kind))
+        for row in rows:
+            lines.append('amazonctl_%s{service="%s",operation="%s"} %s' % (
+                name, row["service"], row["operation"], row[field]))
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics_trace(path):
+    """Write the record of each call to a JSON Lines file."""
+    with open(path, "w") as trace:
+        for record in get_metrics():
+            trace.write(json.dumps(record) + "\n")
+
+
+def paginate(service, operation, key, page_size=None, max_items=None,
+             **params):
+    """Yield the items under key from each page of an operation's results.
+
+    Operations that AWS doesn't paginate are called once.
+
+    """
+    client = get_client(service)
+    if not client.can_paginate(operation):
+        response = getattr(client, operation)(**params)
+        yield from itertools.islice(response.get(key, []), max_items)
+        return
+    config = {}
+    if page_size is not None:
+        config["PageSize"] = page_size
+    if max_items is not None:
+        config["MaxItems"] = max_items
+    params["PaginationConfig"] = config
+    paginator = client.get_paginator(operation)
+    for page in paginator.paginate(**params):
+        yield from page.get(key, [])
+
+
+def describe_in_batches(service, operation, key, items, batch_size,
+                        **params):
+    """Describe items a batch at a time and merge the responses.
+
+    The batches are sent concurrently, ``BATCH_WORKERS`` at most at once.
+
+    """
+    client = get_client(service)
+    call = getattr(client, operation)
+    items = iter(items)
+    batches = iter(lambda: list(itertools.islice(items, batch_size)), [])
+    fresh = getattr(_fresh, "on", False)
+
+    def describe(batch):
+        with fresh_reads(fresh):
+            return call(**params, **{key: batch})
+
+    with ThreadPoolExecutor(BATCH_WORKERS) as pool:
+        responses = list(pool.map(describe, batches))
+    result = {}
+    result[key] = []
+    result["failures"] = []
+    for response in responses:
+        result[key].extend(response.get(key, []))
+        result["failures"].extend(response.get("failures", []))
+    return result
+
+
+def settle(describe, names, settled, timeout=WAIT_TIMEOUT, delay=WAIT_DELAY,
+           max_delay=WAIT_MAX_DELAY):
+    """Yield each name and resource as soon as the resource settles.
+
+    Each round, ``describe`` is called once with the names still pending
+    and returns their resources by name; ``settled`` then says which ones
+    are done. Resources ``describe`` doesn't return are passed as None.
+    Rounds are spaced by a jittered backoff that doubles from ``delay`` up
+    to ``max_delay``. Raises TimeoutError after ``timeout`` seconds.
+
+    """
+    pending = list(dict.fromkeys(names))
+    deadline = time.monotonic() + timeout
+    attempt = 0
+    while pending:
+        with fresh_reads():
+            resources = describe(pending)
+        for name in list(pending):
+            resource = resources.get(name)
+            if settled(resource):
+                pending.remove(name)
+                yield name, resource
+        if not pending:
+            return
+        ceiling = min(max_delay, delay * 2 ** attempt)
+        pause = random.uniform(ceiling / 2, ceiling)
+        attempt += 1
+        if time.monotonic() + pause > deadline:
+            raise TimeoutError("Still waiting for " + ", ".join(pending))
+        time.sleep(pause)
+
+
+def wait_until(describe, names, settled, each=None, **options):
+    """Block until every resource settles and return them by name.
+
+    ``each``, if given, is called with each name and resource as soon as
+    that resource settles.
+
+    """
+    result = {}
+    for name, resource in settle(describe, names, settled, **options):
+        result[name] = resource
+        if each:
+            each(name, resource)
+    return result
 
 
 
@@ -137,12 +908,29 @@ def delete_vpc(vpc_id):
     params["VpcId"] = vpc_id
     return client.delete_vpc(**params)
 
+def get_regions():
+    """List info about all regions enabled for the account."""
+    client = get_client("ec2")
+    return client.describe_regions()
+
+
+def iter_regions(page_size=None, max_items=None):
+    """Yield info about each region enabled for the account."""
+    return paginate("ec2", "describe_regions", "Regions",
+                    page_size, max_items)
+
+
 def get_vpcs():
     """List info about all VPCs."""
     client = get_client("ec2")
     return client.describe_vpcs()
 
 
+def iter_vpcs(page_size=None, max_items=None):
+    """Yield info about each VPC."""
+    return paginate("ec2", "describe_vpcs", "Vpcs", page_size, max_items)
+
+
 def create_subnet(vpc_id, cidr_block):
     """Create a subnet in a VPC."""
     client = get_client("ec2")
@@ -166,6 +954,10 @@ def get_subnets():
     return client.describe_subnets()
 
 
+def iter_subnets(page_size=None, max_items=None):
+    """Yield info about each subnet."""
+    return paginate("ec2", "describe_subnets", "Subnets", page_size, max_items)
+
 
 """#########################################################################
 
@@ -193,6 +985,21 @@ The same applies to creating and deleting outbound (egress) rules:
 Note that defining security group ingress/egress rules like this are limited
 to VPCs. EC2 classic does it differently.
 
+To make a group's inbound rules match a whole policy, pass every rule as a
+``(protocol, from_port, to_port, cidr_block)`` tuple. Only the rules that
+differ are sent, all the missing ones in one call and all the extra ones
+in another::
+
+    >>> amazonctl.apply_ingress_rules("sg-0fea4969", [
+    ..:     ("tcp", 80, 80, "0.0.0.0/0"),
+    ..:     ("tcp", 443, 443, "0.0.0.0/0"),
+    ..:     ("tcp", 22, 22, "10.0.0.0/8"),
+    ..:     ])
+
+To only add the missing rules and keep the rest::
+
+    >>> amazonctl.apply_egress_rules("sg-0fea4969", rules, prune=False)
+
 To view all security groups::
 
     >>> amazonctl.get_security_groups()
@@ -246,6 +1053,15 @@ To delete that rule, use the ACL ID and the rule number::
 For outbound rules, it's similar, just use ``egress`` in function calls
 instead of ``ingress``, for instance ``create_network_acl_egress_entry()``.
 
+To make an ACL's entries match a whole set, pass each as a ``(rule_num,
+protocol, cidr_block, from_port, to_port, allow)`` tuple. Only entries
+that differ are created, replaced, or deleted, several at a time::
+
+    >>> amazonctl.apply_network_acl_entries("acl-ae3283ca", [
+    ..:     (100, "6", "0.0.0.0/0", 80, 80, True),
+    ..:     (110, "6", "0.0.0.0/0", 443, 443, True),
+    ..:     ], egress=False)
+
 To change a subnet from one ACL to another, use the association ID of the
 subet (which you can get from the ``get_network_acls()`` function), and just
 point that at a different ACL::
@@ -324,12 +1140,112 @@ def delete_egress_rule(security_group_id, protocol, from_port, to_port, cidr_blo
     return client.revoke_security_group_egress(**params)
 
 
+def apply_ingress_rules(security_group_id, rules, prune=True):
+    """Make a security group's ingress rules match a set of rules."""
+    return apply_rules(security_group_id, rules, False, prune)
+
+
+def apply_egress_rules(security_group_id, rules, prune=True):
+    """Make a security group's egress rules match a set of rules."""
+    return apply_rules(security_group_id, rules, True, prune)
+
+
+def apply_rules(security_group_id, rules, egress, prune=True):
+    """Authorize the missing rules and revoke the extra ones.
+
+    Each rule is a ``(protocol, from_port, to_port, cidr_block)`` tuple.
+    All the missing rules go in one request and all the extra ones in
+    another. Rules that grant other security groups or prefix lists are
+    left alone.
+
+    """
+    client = get_client("ec2")
+    params = {}
+    params["GroupIds"] = [security_group_id]
+    with fresh_reads():
+        response = client.describe_security_groups(**params)
+    group = response["SecurityGroups"][0]
+    if egress:
+        permissions = group["IpPermissionsEgress"]
+    else:
+        permissions = group["IpPermissions"]
+    current = set()
+    for permission in permissions:
+        protocol = permission["IpProtocol"]
+        from_port = permission.get("FromPort")
+        to_port = permission.get("ToPort")
+        for ip_range in permission.get("IpRanges", []):
+            current.add(normalize_rule(
+                (protocol, from_port, to_port, ip_range["CidrIp"])))
+        for ip_range in permission.get("Ipv6Ranges", []):
+            current.add(normalize_rule(
+                (protocol, from_port, to_port, ip_range["CidrIpv6"])))
+    wanted = set(normalize_rule(x) for x in rules)
+    missing = sorted(wanted - current, key=str)
+    extra = sorted(current - wanted, key=str) if prune else []
+    result = {}
+    result["authorized"] = missing
+    result["revoked"] = extra
+    params = {}
+    params["GroupId"] = security_group_id
+    if missing:
+        params["IpPermissions"] = pack_rules(missing)
+        if egress:
+            client.authorize_security_group_egress(**params)
+        else:
+            client.authorize_security_group_ingress(**params)
+    if extra:
+        params["IpPermissions"] = pack_rules(extra)
+        if egress:
+            client.revoke_security_group_egress(**params)
+        else:
+            client.revoke_security_group_ingress(**params)
+    return result
+
+
+def normalize_rule(rule):
+    """Spell a rule the way AWS reports it back."""
+    protocol, from_port, to_port, cidr_block = rule
+    protocol = str(protocol).lower()
+    protocol = PROTOCOL_NAMES.get(protocol, protocol)
+    if protocol == "-1":
+        from_port, to_port = None, None
+    return protocol, from_port, to_port, cidr_block
+
+
+def pack_rules(rules):
+    """Pack rules into IpPermissions, one per protocol and port range."""
+    permissions = {}
+    for protocol, from_port, to_port, cidr_block in rules:
+        key = (protocol, from_port, to_port)
+        if key not in permissions:
+            permission = {}
+            permission["IpProtocol"] = protocol
+            if from_port is not None:
+                permission["FromPort"] = from_port
+                permission["ToPort"] = to_port
+            permission["IpRanges"] = []
+            permission["Ipv6Ranges"] = []
+            permissions[key] = permission
+        if ":" in cidr_block:
+            permissions[key]["Ipv6Ranges"].append({"CidrIpv6": cidr_block})
+        else:
+            permissions[key]["IpRanges"].append({"CidrIp": cidr_block})
+    return list(permissions.values())
+
+
 def get_security_groups():
     """List info about all security groups."""
     client = get_client("ec2")
     return client.describe_security_groups()
 
 
+def iter_security_groups(page_size=None, max_items=None):
+    """Yield info about each security group."""
+    return paginate("ec2", "describe_security_groups", "SecurityGroups",
+                    page_size, max_items)
+
+
 def delete_security_group(security_group_id):
     """Delete a security group."""
     client = get_client("ec2")
@@ -360,6 +1276,12 @@ def get_key_pairs():
     return client.describe_key_pairs()
 
 
+def iter_key_pairs(page_size=None, max_items=None):
+    """Yield info about each key pair."""
+    return paginate("ec2", "describe_key_pairs", "KeyPairs",
+                    page_size, max_items)
+
+
 def create_network_acl(vpc_id):
     """Create a network ACL."""
     client = get_client("ec2")
@@ -382,6 +1304,12 @@ def get_network_acls():
     return client.describe_network_acls()
 
 
+def iter_network_acls(page_size=None, max_items=None):
+    """Yield info about each network ACL."""
+    return paginate("ec2", "describe_network_acls", "NetworkAcls",
+                    page_size, max_items)
+
+
 def create_network_acl_ingress_entry(acl_id, rule_num, protocol, cidr_block,
                                      from_port, to_port, allow=True):
     """Create an ACL entry for inbound traffic.
@@ -474,6 +1402,93 @@ def delete_network_acl_egress_entry(acl_id, rule_num):
     return client.delete_network_acl_entry(**params)
 
 
+def apply_network_acl_entries(acl_id, entries, egress=False, prune=True):
+    """Make a network ACL's entries match a set of entries.
+
+    Each entry is a ``(rule_num, protocol, cidr_block, from_port, to_port,
+    allow)`` tuple. Entries are created, replaced, or deleted one call
+    each, as AWS has no batch call for them, but ``BATCH_WORKERS`` calls
+    go out at once. The default rule is left alone, and so are ICMP
+    entries, which need a type and code these tuples can't hold.
+
+    """
+    client = get_client("ec2")
+    params = {}
+    params["NetworkAclIds"] = [acl_id]
+    with fresh_reads():
+        response = client.describe_network_acls(**params)
+    current = {}
+    for entry in response["NetworkAcls"][0]["Entries"]:
+        if entry["Egress"] != egress:
+            continue
+        if entry["RuleNumber"] == DEFAULT_ACL_RULE:
+            continue
+        ports = entry.get("PortRange", {})
+        current[entry["RuleNumber"]] = normalize_acl_entry((
+            entry["RuleNumber"],
+            entry["Protocol"],
+            entry.get("CidrBlock") or entry.get("Ipv6CidrBlock"),
+            ports.get("From"),
+            ports.get("To"),
+            entry["RuleAction"] == "allow",
+            ))
+    wanted = {}
+    for entry in entries:
+        entry = normalize_acl_entry(entry)
+        if entry[1] in ICMP_PROTOCOLS:
+            raise ValueError("ICMP ACL entries aren't supported: %r"
+                             % (entry,))
+        wanted[entry[0]] = entry
+    calls = []
+    result = {}
+    result["created"] = []
+    result["replaced"] = []
+    result["deleted"] = []
+    for rule_num, entry in sorted(wanted.items()):
+        if rule_num not in current:
+            calls.append(("create", entry))
+            result["created"].append(entry)
+        elif current[rule_num] != entry:
+            calls.append(("replace", entry))
+            result["replaced"].append(entry)
+    if prune:
+        for rule_num, entry in sorted(current.items()):
+            if rule_num not in wanted and entry[1] not in ICMP_PROTOCOLS:
+                calls.append(("delete", entry))
+                result["deleted"].append(entry)
+
+    def call(job):
+        action, entry = job
+        rule_num, protocol, cidr_block, from_port, to_port, allow = entry
+        params = {}
+        params["NetworkAclId"] = acl_id
+        params["RuleNumber"] = rule_num
+        params["Egress"] = egress
+        if action != "delete":
+            params["Protocol"] = protocol
+            if ":" in cidr_block:
+                params["Ipv6CidrBlock"] = cidr_block
+            else:
+                params["CidrBlock"] = cidr_block
+            params["RuleAction"] = "allow" if allow else "deny"
+            if from_port is not None:
+                params["PortRange"] = {"From": from_port, "To": to_port}
+        return getattr(client, action + "_network_acl_entry")(**params)
+
+    with ThreadPoolExecutor(BATCH_WORKERS) as pool:
+        list(pool.map(call, calls))
+    return result
+
+
+def normalize_acl_entry(entry):
+    """Spell an ACL entry the way AWS reports it back."""
+    rule_num, protocol, cidr_block, from_port, to_port, allow = entry
+    protocol = str(protocol)
+    if protocol not in ("6", "17"):
+        from_port, to_port = None, None
+    return rule_num, protocol, cidr_block, from_port, to_port, allow
+
+
 def change_network_acl_association(acl_id, assoc_id):
     """Change an ACL's association."""
     client = get_client("ec2")
@@ -519,6 +1534,10 @@ To delete an auto scaling group::
 
     >>> amazonctl.delete_auto_scaling_group("my-asg")
 
+To wait until groups have all their instances in service, or are gone::
+
+    >>> amazonctl.wait_for_auto_scaling_groups(["my-asg", "other-asg"])
+
 Note: if you want to use an auto scaling group with a cluster, tell the
 launch config which cluster to use, e.g.,::
 
@@ -572,6 +1591,12 @@ def get_launch_configurations():
     return client.describe_launch_configurations()
 
 
+def iter_launch_configurations(page_size=None, max_items=None):
+    """Yield info about each launch configuration."""
+    return paginate("autoscaling", "describe_launch_configurations",
+                    "LaunchConfigurations", page_size, max_items)
+
+
 def create_auto_scaling_group(name, launch_configuration, min_size=1,
                               max_size=1, desired_size=1, subnets=None):
     """Create an auto scaling group."""
@@ -602,6 +1627,38 @@ def get_auto_scaling_groups():
     return client.describe_auto_scaling_groups()
 
 
+def iter_auto_scaling_groups(page_size=None, max_items=None):
+    """Yield info about each auto scaling group."""
+    return paginate("autoscaling", "describe_auto_scaling_groups",
+                    "AutoScalingGroups", page_size, max_items)
+
+
+def wait_for_auto_scaling_groups(names, each=None, **options):
+    """Block until auto scaling groups are fully in service, or gone."""
+
+    def describe(pending):
+        found = {}
+        for i in range(0, len(pending), ASG_BATCH_SIZE):
+            params = {}
+            params["AutoScalingGroupNames"] = pending[i:i + ASG_BATCH_SIZE]
+            groups = paginate("autoscaling", "describe_auto_scaling_groups",
+                              "AutoScalingGroups", **params)
+            for group in groups:
+                found[group["AutoScalingGroupName"]] = group
+        return found
+
+    def settled(group):
+        if group is None:
+            return True
+        if group.get("Status"):
+            return False
+        healthy = [x for x in group["Instances"]
+                   if x["LifecycleState"] == "InService"
+                   and x["HealthStatus"] == "Healthy"]
+        return len(healthy) == group["DesiredCapacity"]
+
+    return wait_until(describe, names, settled, each, **options)
+
 
 """#########################################################################
 
@@ -670,6 +1727,12 @@ def get_load_balancers():
     return client.describe_load_balancers()
 
 
+def iter_load_balancers(page_size=None, max_items=None):
+    """Yield info about each load balancer."""
+    return paginate("elb", "describe_load_balancers",
+                    "LoadBalancerDescriptions", page_size, max_items)
+
+
 def attach_load_balancer(group_name, load_balancer_name):
     """Attach a load balancer to an auto scaling group."""
     client = get_client("autoscaling")
@@ -721,6 +1784,20 @@ To delete a stack::
 
     >>> amazonctl.delete_stack("my-stack")
 
+To wait until stacks are done being created, updated, or deleted::
+
+    >>> amazonctl.wait_for_stacks(["my-stack", "other-stack"])
+
+Each ``wait_for_*`` function checks on all the resources it waits for
+with one round of describe calls, backing off between rounds (with a
+bit of randomness so many waiters don't poll in lockstep), and stops
+checking on each resource as soon as it's done. To hear about each one
+as it finishes, or to change how long to wait::
+
+    >>> amazonctl.wait_for_stacks(["my-stack", "other-stack"],
+    ..:     each=lambda name, stack: print(name, stack["StackStatus"]),
+    ..:     timeout=600, max_delay=10)
+
 """
 
 def create_stack(name, template, parameters=None):
@@ -756,6 +1833,49 @@ def get_stacks():
     return client.describe_stacks()
 
 
+def iter_stacks(page_size=None, max_items=None):
+    """Yield info about each stack."""
+    return paginate("cloudformation", "describe_stacks", "Stacks",
+                    page_size, max_items)
+
+
+def find_stack(name):
+    """List the stack with a name or ID, or nothing if there is none."""
+    client = get_client("cloudformation")
+    try:
+        return client.describe_stacks(StackName=name)["Stacks"]
+    except client.exceptions.ClientError as error:
+        if "does not exist" not in error.response["Error"]["Message"]:
+            raise
+        return []
+
+
+def wait_for_stacks(names, each=None, **options):
+    """Block until stacks finish changing, or are gone.
+
+    While only a few stacks are pending each is described by name;
+    above ``STACK_LOOKUPS`` every stack in the account is listed instead.
+
+    """
+
+    def describe(pending):
+        if len(pending) > STACK_LOOKUPS:
+            stacks = iter_stacks()
+        else:
+            stacks = itertools.chain.from_iterable(map(find_stack, pending))
+        found = {}
+        for stack in stacks:
+            found[stack["StackName"]] = stack
+            found[stack["StackId"]] = stack
+        return found
+
+    def settled(stack):
+        if stack is None:
+            return True
+        return not stack["StackStatus"].endswith("_IN_PROGRESS")
+
+    return wait_until(describe, names, settled, each, **options)
+
 
 """#########################################################################
 
@@ -878,6 +1998,23 @@ To delete a service from a cluster::
 
     >>> amazonctl.delete_service("my-service", "my-cluster")
 
+To wait until services have settled into a steady state::
+
+    >>> amazonctl.wait_for_services_stable("my-cluster", ["my-service"])
+
+AWS describes at most 100 clusters, container instances, or tasks per
+call, and 10 services. ``get_clusters()``, ``get_container_instances()``,
+``get_tasks()``, and ``get_services()`` split longer lists into batches,
+send a few batches at a time, and merge the results and the "failures",
+so you can hand them every ARN at once::
+
+    >>> task_arns = amazonctl.iter_task_arns("my-cluster")
+    >>> amazonctl.get_tasks("my-cluster", task_arns)
+
+To get info about everything in a cluster in one go::
+
+    >>> amazonctl.get_cluster_contents("my-cluster")
+
 """
 
 
@@ -903,27 +2040,41 @@ def get_cluster_arns():
     return client.list_clusters()
 
 
+def iter_cluster_arns(page_size=None, max_items=None):
+    """Yield each cluster ARN."""
+    return paginate("ecs", "list_clusters", "clusterArns",
+                    page_size, max_items)
+
+
 def get_clusters(clusters):
-    """List info about the specified clusters."""
-    client = get_client("ecs")
-    params = {}
-    params["clusters"] = clusters
-    return client.describe_clusters(**params)
+    """List info about the specified clusters, any number of them."""
+    return describe_in_batches("ecs", "describe_clusters", "clusters",
+                               clusters, ECS_BATCH_SIZE)
 
 
 def get_container_instance_arns(cluster):
     """List all container instance ARNs."""
     client = get_client("ecs")
-    return client.list_container_instances()
+    params = {}
+    params["cluster"] = cluster
+    return client.list_container_instances(**params)
+
+
+def iter_container_instance_arns(cluster, page_size=None, max_items=None):
+    """Yield each container instance ARN in a cluster."""
+    params = {}
+    params["cluster"] = cluster
+    return paginate("ecs", "list_container_instances", "containerInstanceArns",
+                    page_size, max_items, **params)
 
 
 def get_container_instances(cluster, instances):
     """List info about the container instances in a cluster."""
-    client = get_client("ecs")
     params = {}
     params["cluster"] = cluster
-    params["containerInstances"] = instances
-    return client.describe_container_instances(**params)
+    return describe_in_batches("ecs", "describe_container_instances",
+                               "containerInstances", instances,
+                               ECS_BATCH_SIZE, **params)
 
 
 def create_task_definition(json_file):
@@ -944,6 +2095,12 @@ def get_task_definition_arns():
     return client.list_task_definitions()
 
 
+def iter_task_definition_arns(page_size=None, max_items=None):
+    """Yield each task definition ARN."""
+    return paginate("ecs", "list_task_definitions", "taskDefinitionArns",
+                    page_size, max_items)
+
+
 def get_task_definition(task_definition):
     """List info about the specified task definition."""
     client = get_client("ecs")
@@ -972,13 +2129,20 @@ def get_task_arns(cluster):
     return client.list_tasks(**params)
 
 
+def iter_task_arns(cluster, page_size=None, max_items=None):
+    """Yield each task ARN in a cluster."""
+    params = {}
+    params["cluster"] = cluster
+    return paginate("ecs", "list_tasks", "taskArns",
+                    page_size, max_items, **params)
+
+
 def get_tasks(cluster, tasks):
     """Get info about the tasks in a cluster."""
-    client = get_client("ecs")
     params = {}
     params["cluster"] = cluster
-    params["tasks"] = tasks
-    return client.describe_tasks(**params)
+    return describe_in_batches("ecs", "describe_tasks", "tasks", tasks,
+                               ECS_BATCH_SIZE, **params)
 
 
 def run_task(cluster, task_definition):
@@ -1007,13 +2171,20 @@ def get_service_arns(cluster):
     return client.list_services(**params)
 
 
+def iter_service_arns(cluster, page_size=None, max_items=None):
+    """Yield each service ARN in a cluster."""
+    params = {}
+    params["cluster"] = cluster
+    return paginate("ecs", "list_services", "serviceArns",
+                    page_size, max_items, **params)
+
+
 def get_services(cluster, services):
     """Get info about the services in a cluster."""
-    client = get_client("ecs")
     params = {}
     params["cluster"] = cluster
-    params["services"] = services
-    return client.describe_services(**params)
+    return describe_in_batches("ecs", "describe_services", "services",
+                               services, ECS_SERVICE_BATCH_SIZE, **params)
 
 
 def create_service(name, cluster, task_definition, count=1,
@@ -1054,12 +2225,59 @@ def update_service(name, cluster, task_definition=None, count=None):
     return client.update_service(**params)
 
 
-def wait_for_instances_to_terminate(instance_ids):
+def get_cluster_contents(cluster):
+    """Get info about every instance, service, and task in a cluster."""
+    instances = get_container_instances(
+        cluster, iter_container_instance_arns(cluster))
+    services = get_services(cluster, iter_service_arns(cluster))
+    tasks = get_tasks(cluster, iter_task_arns(cluster))
+    result = {}
+    result["containerInstances"] = instances["containerInstances"]
+    result["services"] = services["services"]
+    result["tasks"] = tasks["tasks"]
+    result["failures"] = (instances["failures"] + services["failures"]
+                          + tasks["failures"])
+    return result
+
+
+def wait_for_services_stable(cluster, services, each=None, **options):
+    """Block until services in a cluster reach a steady state."""
+
+    def describe(pending):
+        found = {}
+        for service in get_services(cluster, pending)["services"]:
+            found[service["serviceName"]] = service
+            found[service["serviceArn"]] = service
+        return found
+
+    def settled(service):
+        if service is None or service["status"] == "INACTIVE":
+            return True
+        return (len(service["deployments"]) == 1
+                and service["runningCount"] == service["desiredCount"])
+
+    return wait_until(describe, services, settled, each, **options)
+
+
+def wait_for_instances_to_terminate(instance_ids, each=None, **options):
     """Block until EC2 instances terminate."""
-    client = get_client("ec2")
-    waiter = client.get_waiter("instance_terminated")
-    waiter.config.max_attempts = 15
-    waiter.wait(InstanceIds=instance_ids)
+
+    def describe(pending):
+        found = {}
+        for i in range(0, len(pending), INSTANCE_BATCH_SIZE):
+            params = {}
+            params["InstanceIds"] = pending[i:i + INSTANCE_BATCH_SIZE]
+            reservations = paginate("ec2", "describe_instances",
+                                    "Reservations", **params)
+            for reservation in reservations:
+                for instance in reservation["Instances"]:
+                    found[instance["InstanceId"]] = instance
+        return found
+
+    def settled(instance):
+        return instance is None or instance["State"]["Name"] == "terminated"
+
+    return wait_until(describe, instance_ids, settled, each, **options)
 
 
 """#########################################################################
@@ -1104,11 +2322,29 @@ To delete an environment::
 
     >>> amazonctl.delete_environment("my-env")
 
+To wait until environments are ready (or terminated)::
+
+    >>> amazonctl.wait_for_environments(["my-env"])
+
 To upload an application version zip::
 
     >>> amazonctl.upload_application_version("v1.5.0.zip", "my-eb-bucket",
     ..:     "v1.5.0.zip")
 
+Big zips are sent in parts, several at once. To pick the part size and
+watch the upload go::
+
+    >>> amazonctl.upload_application_version("v1.5.0.zip", "my-eb-bucket",
+    ..:     "v1.5.0.zip", part_size=16 * 1024 * 1024,
+    ..:     progress=lambda sent, total: print(sent, "of", total))
+
+A failed upload is aborted. To be able to pick it up where it stopped
+instead, skipping the parts S3 already has, pass ``resume=True`` both
+times::
+
+    >>> amazonctl.upload_application_version("v1.5.0.zip", "my-eb-bucket",
+    ..:     "v1.5.0.zip", resume=True)
+
 To create a new application version::
 
     >>> amazonctl.create_application_version("v1.5.0", "my-app",
@@ -1149,12 +2385,24 @@ def get_applications():
     return client.describe_applications()
 
 
+def iter_applications(page_size=None, max_items=None):
+    """Yield info about each Elastic Beanstalk application."""
+    return paginate("elasticbeanstalk", "describe_applications",
+                    "Applications", page_size, max_items)
+
+
 def get_solution_stacks():
     """Get a list of all available solution stacks."""
     client = get_client("elasticbeanstalk")
     return client.list_available_solution_stacks()
 
 
+def iter_solution_stacks(page_size=None, max_items=None):
+    """Yield the name of each available solution stack."""
+    return paginate("elasticbeanstalk", "list_available_solution_stacks",
+                    "SolutionStacks", page_size, max_items)
+
+
 def get_multicontainer_docker_solution_stack():
     """Get the Multi-Container Docker solution stack."""
     response = get_solution_stacks()
@@ -1258,6 +2506,35 @@ def get_environments():
     return client.describe_environments()
 
 
+def iter_environments(page_size=None, max_items=None):
+    """Yield info about each environment."""
+    return paginate("elasticbeanstalk", "describe_environments",
+                    "Environments", page_size, max_items)
+
+
+def wait_for_environments(names, each=None, **options):
+    """Block until environments are ready or terminated."""
+
+    def describe(pending):
+        found = {}
+        params = {}
+        params["EnvironmentNames"] = pending
+        environments = paginate("elasticbeanstalk", "describe_environments",
+                                "Environments", **params)
+        for environment in environments:
+            name = environment["EnvironmentName"]
+            if name not in found or found[name]["Status"] == "Terminated":
+                found[name] = environment
+        return found
+
+    def settled(environment):
+        if environment is None:
+            return True
+        return environment["Status"] in ("Ready", "Terminated")
+
+    return wait_until(describe, names, settled, each, **options)
+
+
 def create_eb_bucket():
     """Create an S3 bucket to store application versions in."""
     client = get_client("elasticbeanstalk")
@@ -1296,13 +2573,345 @@ def get_application_versions(application):
     return client.describe_application_versions(**params)
 
 
-def upload_application_version(zip_file, s3bucket, s3key):
-    """Upload an application version zip to S3."""
-    with open(zipfile, "rb") as f:
-        data = f.read()
+def iter_application_versions(application, page_size=None, max_items=None):
+    """Yield info about each version of an application."""
+    params = {}
+    params["ApplicationName"] = application
+    return paginate("elasticbeanstalk", "describe_application_versions",
+                    "ApplicationVersions", page_size, max_items, **params)
+
+
+def upload_application_version(zip_file, s3bucket, s3key,
+                               part_size=PART_SIZE, progress=None,
+                               resume=False):
+    """Upload an application version zip to S3.
+
+    Bundles bigger than ``part_size`` go up as a multipart upload, a few
+    parts at a time, each with a SHA-256 checksum S3 verifies. A failed
+    multipart upload is aborted, unless ``resume`` is true: then its ID
+    is kept in a ``.upload`` file next to the zip, and the next call with
+    ``resume`` reuses the parts it holds when their checksums match.
+    ``progress``, if given, is called with the bytes sent so far and the
+    total.
+
+    """
+    size = os.path.getsize(zip_file)
+    client = get_client("s3")
+    if size <= part_size:
+        with open(zip_file, "rb") as f:
+            params = {}
+            params["Body"] = f
+            params["Bucket"] = s3bucket
+            params["Key"] = s3key
+            params["ChecksumAlgorithm"] = "SHA256"
+            response = client.put_object(**params)
+        if progress:
+            progress(size, size)
+        return response
+    part_size = max(part_size, MIN_PART_SIZE, -(-size // MAX_PARTS))
+    state_file = zip_file + ".upload"
+    state = {}
+    state["Bucket"] = s3bucket
+    state["Key"] = s3key
+    state["Size"] = size
+    state["PartSize"] = part_size
+    upload_id, uploaded = None, {}
+    if resume:
+        upload_id = read_upload_state(state_file, state)
+    if upload_id:
+        try:
+            uploaded = get_uploaded_parts(s3bucket, s3key, upload_id)
+        except client.exceptions.NoSuchUpload:
+            upload_id = None
+    if not upload_id:
+        params = {}
+        params["Bucket"] = s3bucket
+        params["Key"] = s3key
+        params["ChecksumAlgorithm"] = "SHA256"
+        response = client.create_multipart_upload(**params)
+        upload_id = response["UploadId"]
+        if resume:
+            state["UploadId"] = upload_id
+            with open(state_file, "w") as f:
+                json.dump(state, f)
+    sent = [0]
+    lock = threading.Lock()
+
+    def upload(number):
+        with open(zip_file, "rb") as f:
+            f.seek((number - 1) * part_size)
+            data = f.read(part_size)
+        checksum = base64.b64encode(hashlib.sha256(data).digest()).decode()
+        part = uploaded.get(number)
+        if part is None or part.get("ChecksumSHA256") != checksum:
+            params = {}
+            params["Body"] = data
+            params["Bucket"] = s3bucket
+            params["Key"] = s3key
+            params["UploadId"] = upload_id
+            params["PartNumber"] = number
+            params["ChecksumSHA256"] = checksum
+            response = client.upload_part(**params)
+            part = {}
+            part["ETag"] = response["ETag"]
+            part["ChecksumSHA256"] = checksum
+        if progress:
+            with lock:
+                sent[0] += len(data)
+                progress(sent[0], size)
+        return {
+            "ETag": part["ETag"],
+            "ChecksumSHA256": checksum,
+            "PartNumber": number,
+            }
+
+    numbers = range(1, -(-size // part_size) + 1)
+    try:
+        with ThreadPoolExecutor(UPLOAD_WORKERS) as pool:
+            parts = list(pool.map(upload, numbers))
+    except BaseException:
+        if not resume:
+            abort_multipart_upload(s3bucket, s3key, upload_id)
+        raise
+    params = {}
+    params["Bucket"] = s3bucket
+    params["Key"] = s3key
+    params["UploadId"] = upload_id
+    params["MultipartUpload"] = {"Parts": parts}
+    response = client.complete_multipart_upload(**params)
+    if resume and os.path.exists(state_file):
+        os.remove(state_file)
+    return response
+
+
+def read_upload_state(state_file, expected):
+    """Get the upload ID a state file kept, if it's for the same upload."""
+    try:
+        with open(state_file) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if any(state.get(key) != value for key, value in expected.items()):
+        return None
+    return state.get("UploadId")
+
+
+def get_uploaded_parts(s3bucket, s3key, upload_id):
+    """Map part numbers to the parts a multipart upload already holds."""
+    params = {}
+    params["Bucket"] = s3bucket
+    params["Key"] = s3key
+    params["UploadId"] = upload_id
+    parts = paginate("s3", "list_parts", "Parts", **params)
+    return {x["PartNumber"]: x for x in parts}
+
+
+def abort_multipart_upload(s3bucket, s3key, upload_id):
+    """Abort a multipart upload and drop the parts it holds."""
     client = get_client("s3")
     params = {}
-    params["Body"] = data
     params["Bucket"] = s3bucket
     params["Key"] = s3key
-    return client.put_object(**params)
+    params["UploadId"] = upload_id
+    return client.abort_multipart_upload(**params)
+
+
+
+"""#########################################################################
+
+Command Line
+------------
+
+Every function above is also a command: swap the underscores for dashes
+and pass the arguments in the same order::
+
+    > python amazonctrl.py get-vpcs
+    > python amazonctrl.py create-stack my-stack my-stack.template
+    > python amazonctrl.py get-tasks my-cluster arn:aws:ecs:... arn:aws:ecs:...
+
+Optional arguments become options, and ``--help`` lists them::
+
+    > python amazonctrl.py create-service --help
+    > python amazonctrl.py create-service my-service my-cluster demo --count 3
+
+To use another profile or region::
+
+    > python amazonctrl.py --profile prod --region eu-west-1 get-stacks
+
+To run a command in many regions, or in the accounts of roles you can
+assume, all at once::
+
+    > python amazonctrl.py --regions us-east-1,eu-west-1 get-stacks
+    > python amazonctrl.py --role arn:aws:iam::111111111111:role/Audit \\
+          --role arn:aws:iam::222222222222:role/Audit get-auto-scaling-groups
+
+To see which AWS calls a command made, how long they took, and whether
+they were retried or throttled::
+
+    > python amazonctrl.py --metrics table get-cluster-contents my-cluster
+    > python amazonctrl.py --trace calls.jsonl get-cluster-contents my-cluster
+
+Results print as JSON. The ``iter-*`` commands print one item per line as
+each page arrives.
+
+boto3 is only loaded once a command calls AWS, so ``--help``, bad
+arguments, and shell completion answer right away. To turn on completion
+in bash, put this file on your PATH as ``amazonctl`` and run::
+
+    > eval "$(_AMAZONCTL_COMPLETE=bash_source amazonctl)"
+
+"""
+
+
+PLUMBING = {
+    "get_client", "configure_clients", "invalidate_clients", "paginate",
+    "describe_in_batches", "settle", "wait_until", "enable_cache",
+    "disable_cache", "clear_cache", "watch_cache", "split_operation",
+    "get_cached_subjects", "get_account", "fresh_reads",
+    "mark_cached_call", "serve_cached_call", "store_cached_call",
+    "apply_rules", "normalize_rule", "pack_rules",
+    "normalize_acl_entry", "enable_metrics", "disable_metrics",
+    "clear_metrics", "get_metrics", "watch_calls", "start_call",
+    "count_attempt", "record_call", "record_failed_call", "new_record",
+    "keep_record", "summarize_metrics", "format_metrics_table",
+    "format_metrics_prometheus", "write_metrics_trace", "report_metrics",
+    "make_session", "target", "fan_out", "read_upload_state", "find_stack",
+    "make_command",
+    "echo_settled", "echo_progress", "add_commands",
+    }
+LIST_PARAMS = {
+    "clusters", "instances", "tasks", "services", "names", "instance_ids",
+    "subnets", "security_groups",
+    }
+INT_PARAMS = {
+    "from_port", "to_port", "rule_num", "elb_port", "instance_port",
+    "count", "min_size", "max_size", "desired_size", "part_size",
+    "page_size", "max_items",
+    }
+JSON_PARAMS = {"parameters", "rules", "entries"}
+
+
+def make_command(function):
+    """Wrap a function in a click command."""
+    signature = inspect.signature(function)
+    params = []
+    for parameter in signature.parameters.values():
+        name = parameter.name
+        if parameter.kind is parameter.VAR_KEYWORD:
+            continue
+        if name in ("each", "progress"):
+            continue
+        flag = name.replace("_", "-")
+        kind = int if name in INT_PARAMS else None
+        if parameter.default is parameter.empty:
+            nargs = -1 if name in LIST_PARAMS else 1
+            params.append(click.Argument(
+                [name], type=kind, nargs=nargs, required=True))
+        elif isinstance(parameter.default, bool):
+            params.append(click.Option(
+                ["--%s/--no-%s" % (flag, flag)], default=parameter.default,
+                show_default=True))
+        else:
+            params.append(click.Option(
+                ["--" + flag], type=kind, default=parameter.default,
+                multiple=name in LIST_PARAMS,
+                show_default=parameter.default is not None))
+
+    def callback(**kwargs):
+        for name in LIST_PARAMS & kwargs.keys():
+            kwargs[name] = list(kwargs[name]) or None
+        for name in JSON_PARAMS & kwargs.keys():
+            if kwargs[name] is not None:
+                kwargs[name] = json.loads(kwargs[name])
+        if "each" in signature.parameters:
+            kwargs["each"] = echo_settled
+        if "progress" in signature.parameters:
+            kwargs["progress"] = echo_progress
+        targets = click.get_current_context().find_root().obj or {}
+        try:
+            if targets.get("regions") or targets.get("roles"):
+                result = fan_out(function, targets["regions"],
+                                 targets["roles"], kwargs=kwargs)
+            else:
+                result = function(**kwargs)
+            if inspect.isgenerator(result):
+                for item in result:
+                    click.echo(json.dumps(item, default=str))
+            else:
+                click.echo(json.dumps(result, indent=2, default=str))
+        except Exception as error:
+            from botocore.exceptions import BotoCoreError, ClientError
+            if isinstance(error, (BotoCoreError, ClientError)):
+                raise click.ClickException(str(error))
+            raise
+
+    name = function.__name__.replace("_", "-")
+    return click.Command(name, params=params, callback=callback,
+                         help=inspect.getdoc(function))
+
+
+def echo_settled(name, resource):
+    """Tell the user a resource has settled."""
+    click.echo("%s is done" % name, err=True)
+
+
+def echo_progress(sent, total):
+    """Tell the user how far an upload has got."""
+    end = "\n" if sent == total else ""
+    click.echo("\rsent %d of %d bytes%s" % (sent, total, end), nl=False,
+               err=True)
+
+
+def report_metrics(metrics, trace):
+    """Show or write what the recorded calls did."""
+    if metrics == "table":
+        click.echo(format_metrics_table(), err=True)
+    elif metrics == "prometheus":
+        click.echo(format_metrics_prometheus(), err=True, nl=False)
+    if trace:
+        write_metrics_trace(trace)
+
+
+@click.group(context_settings={"help_option_names": ["-h", "--help"]})
+@click.option("--profile", help="AWS profile to use.")
+@click.option("--region", help="AWS region to use.")
+@click.option("--metrics", type=click.Choice(["table", "prometheus"]),
+              help="Sum up the AWS calls made on stderr.")
+@click.option("--trace", type=click.Path(dir_okay=False),
+              help="Write each AWS call made to a JSON Lines file.")
+@click.option("--regions", help="Run in each of these regions, "
+                                "separated by commas.")
+@click.option("--role", "roles", multiple=True,
+              help="Run in the account of this role, which is assumed. "
+                   "May repeat.")
+@click.pass_context
+def cli(context, profile, region, metrics, trace, regions, roles):
+    """Control AWS resources."""
+    context.obj = {}
+    context.obj["regions"] = regions.split(",") if regions else None
+    context.obj["roles"] = list(roles) or None
+    if profile:
+        os.environ["AWS_PROFILE"] = profile
+    if region:
+        os.environ["AWS_DEFAULT_REGION"] = region
+    if metrics or trace:
+        enable_metrics()
+        context.call_on_close(functools.partial(report_metrics, metrics,
+                                                trace))
+
+
+def add_commands(group):
+    """Add a command to a group for each function above."""
+    for name, function in list(globals().items()):
+        if not inspect.isfunction(function) or name in PLUMBING:
+            continue
+        if function.__module__ != __name__ or name.startswith("_"):
+            continue
+        group.add_command(make_command(function))
+
+
+add_commands(cli)
+
+
+if __name__ == "__main__":
+    cli(prog_name="amazonctl", complete_var="_AMAZONCTL_COMPLETE")
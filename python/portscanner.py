@@ -1,69 +1,1930 @@
 #! /usr/bin/env python3
 import argparse
+import array
+import asyncio
 import collections
+import concurrent.futures
+import csv
+import datetime
+import errno
+import ipaddress
 import itertools
+import json
+import math
 import multiprocessing
-import operator
+import multiprocessing.connection
+import os
+import queue
+import random
+import re
+import select
+import signal
 import socket
+import sqlite3
+import ssl
+import struct
+import sys
+import threading
+import time
+import zlib
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 PURPOSE = 'Scan for open ports on a computer.'
 PORTS = range(1 << 16)
 POOL_SIZE = 1 << 8
-TIMEOUT = 0.01
+SPARE_FILES = 1 << 6
+TIMEOUT = 1.0
+MIN_TIMEOUT = 0.01
+MAX_TIMEOUT = 10.0
+SAMPLES = 3
+BACKOFF = 2
+RETRIES = 1
+LIMIT = 1 << 12
+PER_HOST = 1 << 10
+TTL = 300.0
+IN_PROGRESS = {errno.EINPROGRESS}
+if sys.platform == 'win32':
+    IN_PROGRESS.add(errno.EWOULDBLOCK)
+CONGESTION = {errno.ENOBUFS, errno.EAGAIN, errno.EMFILE, errno.ENFILE,
+              errno.EADDRNOTAVAIL} - IN_PROGRESS
+OPEN, CLOSED, FILTERED, BUSY = 'open', 'closed', 'filtered', 'busy'
+OPEN_FILTERED = 'open|filtered'
+SILENT = {FILTERED, OPEN_FILTERED}
+TCP, UDP = 'tcp', 'udp'
+DATAGRAM_SIZE = 1 << 16
+DNS_QUERY = bytes.fromhex('5053010000010000000000000000020001')
+NTP_REQUEST = b'\x1b' + bytes(47)
+SNMP_REQUEST = bytes.fromhex('302902010004067075626c6963a01c0204706f7274'
+                             '020100020100300e300c06082b060102010101000500')
+PAYLOADS = {53: DNS_QUERY, 123: NTP_REQUEST, 161: SNMP_REQUEST,
+            5353: DNS_QUERY}
+STATES = OPEN, CLOSED, FILTERED, BUSY, OPEN_FILTERED
+JOB = struct.Struct('=Hd')
+RESULT = struct.Struct('=HBd')
+BURST = 0.01
+MIN_RATE = 10.0
+RECOVERY = 10.0
+SAVE_EVERY = 10.0
+MAGIC = b'portscanner state 3\n'
+CHUNK = struct.Struct('>I')
+RECORD = struct.Struct('>cHII')
+SAMPLE = 1 / 16
+UNITS = dict(s=1, m=60, h=60 * 60, d=24 * 60 * 60)
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS scans (
+        time REAL PRIMARY KEY, protocol TEXT, ports INTEGER);
+    CREATE TABLE IF NOT EXISTS ports (
+        host TEXT, family INTEGER, protocol TEXT, port INTEGER, time REAL,
+        state TEXT, latency REAL, service TEXT,
+        PRIMARY KEY (host, family, protocol, port, time));
+'''
+FIELDS = ('time', 'host', 'family', 'port', 'state', 'latency', 'service',
+          'error')
+VERSIONS = {4: socket.AF_INET, 6: socket.AF_INET6}
+TAGS = 'ipv4:', 'ipv6:'
+BANNER_LIMIT = 1 << 6
+BANNER_TIMEOUT = 1.0
+BANNER_SIZE = 1 << 10
+HTTP_PROBE = b'HEAD / HTTP/1.0\r\n\r\n'
+SIGNATURES = (
+    (rb'^SSH-[\d.]+-(\S*)', 'ssh'),
+    (rb'^HTTP/[\d.]+ .*?^Server: *([^\r\n]*)', 'http'),
+    (rb'^HTTP/[\d.]+ ', 'http'),
+    (rb'^220[ -](.*FTP.*?)\r?$', 'ftp'),
+    (rb'^220[ -](.*SMTP.*?)\r?$', 'smtp'),
+    (rb'^\+OK', 'pop3'),
+    (rb'^\* OK', 'imap'),
+    (rb'^RFB (\d+\.\d+)', 'vnc'),
+    (rb'^.{4}\x0a([\d.]+[^\x00]*)\x00', 'mysql'),
+    (rb'^-(?:ERR|NOAUTH)', 'redis'),
+)
+TOP_PORTS = (
+    80, 23, 443, 21, 22, 25, 3389, 110, 445, 139, 143, 53, 135, 3306, 8080,
+    1723, 111, 995, 993, 5900, 1025, 587, 8888, 199, 1720, 465, 548, 113, 81,
+    6001, 10000, 514, 5060, 179, 1026, 2000, 8443, 8000, 32768, 554, 26, 1433,
+    49152, 2001, 515, 8008, 49154, 1027, 5666, 646, 5000, 5631, 631, 49153,
+    8081, 2049, 88, 79, 5800, 106, 2121, 1110, 49155, 6000, 513, 990, 5357,
+    427, 49156, 543, 544, 5101, 144, 7, 389, 8009, 3128, 444, 9999, 5009,
+    7070, 5190, 3000, 5432, 1900, 3986, 13, 1029, 9, 5051, 6646, 49157, 1028,
+    873, 1755, 2717, 4899, 9100, 119, 37)
+WELL_KNOWN = range(1 << 10)
 
 
 def main():
-    """Get computer to scan, connect with process pool, and show open ports."""
+    """Get computers to scan, probe them with an engine, show open ports."""
     parser = argparse.ArgumentParser(description=PURPOSE)
-    parser.add_argument('host', type=str, help='computer you want to scan')
-    host = parser.parse_args().host
-    with multiprocessing.Pool(POOL_SIZE, socket.setdefaulttimeout, [TIMEOUT]) \
-            as pool:
-        results = pool.imap_unordered(test, ((host, port) for port in PORTS))
-        servers = filter(operator.itemgetter(0), results)
-        numbers = map(operator.itemgetter(1), servers)
-        ordered = sorted(numbers)
-    print(f'Ports open on {host}:', *format_ports(ordered), sep='\n    ')
+    parser.add_argument('targets', nargs='*', metavar='target',
+                        help='computer you want to scan: a name, an address, '
+                             'a CIDR block, a range like 10.0.0.1-254, or '
+                             '@file with one target per line')
+    parser.add_argument('--engine', choices=ENGINES, default='pool',
+                        help='how to run the connects (default: %(default)s)')
+    parser.add_argument('--udp', dest='protocol', action='store_const',
+                        const=UDP, default=TCP,
+                        help='send each port a datagram instead, calling it '
+                             'open if anything answers, closed if ICMP says '
+                             'port unreachable, and open|filtered otherwise')
+    parser.add_argument('--limit', type=int, default=LIMIT,
+                        help='connects in flight at once across all hosts '
+                             '(default: %(default)s)')
+    parser.add_argument('--per-host', type=int, default=PER_HOST,
+                        help='connects in flight at once to any one host '
+                             '(default: %(default)s)')
+    parser.add_argument('--ttl', type=float, default=TTL,
+                        help='seconds to reuse resolved addresses before '
+                             'looking them up again (default: %(default)s)')
+    parser.add_argument('--family', choices=('4', '6', 'both'),
+                        help='scan only the IPv4 or the IPv6 addresses of '
+                             'each host, or both side by side with results '
+                             'kept apart (default: every address in turn)')
+    parser.add_argument('--timeout', type=float, default=TIMEOUT,
+                        help='seconds to wait for a connect until a host has '
+                             'answered enough probes to measure its round '
+                             'trip time (default: %(default)s)')
+    parser.add_argument('--retries', type=int, default=RETRIES,
+                        help='times to probe a filtered port again with a '
+                             'longer timeout (default: %(default)s)')
+    parser.add_argument('--pps', type=float,
+                        help='most connects per second across all hosts')
+    parser.add_argument('--host-pps', type=float,
+                        help='most connects per second to any one host')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='halve --pps whenever connects fail for lack of '
+                             'local buffers or the share of timeouts jumps, '
+                             'and recover it gradually')
+    parser.add_argument('--format', choices=WRITERS, default='text',
+                        help='text prints a sorted report per host; jsonl and '
+                             'csv stream each open port as soon as it is '
+                             'found (default: %(default)s)')
+    parser.add_argument('--order', choices=ORDERS,
+                        help='numeric probes ports from 0 up; common probes '
+                             'the most often open ones first (default: '
+                             'common with --top, numeric otherwise)')
+    parser.add_argument('--first', type=port_list, default=(), metavar='PORTS',
+                        help='ports like 22,80,8000-8100 to probe before all '
+                             'others, in the order given')
+    parser.add_argument('--top', type=int, metavar='N',
+                        help='probe only the first N ports of the order')
+    parser.add_argument('--banners', action='store_true',
+                        help='connect again to each open port while the scan '
+                             'goes on and name its service from what it says')
+    parser.add_argument('--banner-limit', type=int, default=BANNER_LIMIT,
+                        help='open ports to identify at once '
+                             '(default: %(default)s)')
+    parser.add_argument('--banner-timeout', type=float, default=BANNER_TIMEOUT,
+                        help='seconds to wait for each connect or reply when '
+                             'identifying a service (default: %(default)s)')
+    parser.add_argument('--state', metavar='FILE',
+                        help='save progress to FILE and skip the ports it '
+                             'says were already probed by a scan of the same '
+                             'protocol and ports')
+    parser.add_argument('--save-every', type=float, default=SAVE_EVERY,
+                        help='seconds between saves of --state '
+                             '(default: %(default)s)')
+    parser.add_argument('--history', metavar='FILE',
+                        help='keep the open ports of every scan, and the '
+                             'ports seen to close, in the SQLite file FILE')
+    parser.add_argument('--diff-since', type=moment, metavar='WHEN',
+                        help='report only ports that opened or closed since '
+                             'WHEN: last for the previous scan, an age such '
+                             'as 12h or 7d, or an ISO date and time')
+    parser.add_argument('--incremental', action='store_true',
+                        help='probe the ports known to be open first and '
+                             'then only a random sample of the others')
+    parser.add_argument('--sample', type=float, default=SAMPLE,
+                        help='share of the other ports to probe with '
+                             '--incremental (default: %(default)s)')
+    parser.add_argument('--summarize', metavar='FILE',
+                        help='print the sorted report for jsonl or csv '
+                             'results saved earlier (- for stdin) instead of '
+                             'scanning')
+    arguments = parser.parse_args()
+    if arguments.summarize is not None:
+        with open_input(arguments.summarize) as file:
+            summarize(file)
+        return
+    if not arguments.targets:
+        parser.error('a target or --summarize is required')
+    if arguments.limit < 1 or arguments.per_host < 1:
+        parser.error('--limit and --per-host must be at least 1')
+    if arguments.timeout <= 0 or arguments.retries < 0:
+        parser.error('--timeout must be positive and --retries not negative')
+    if any(rate is not None and rate <= 0
+           for rate in (arguments.pps, arguments.host_pps)):
+        parser.error('--pps and --host-pps must be positive')
+    if arguments.adaptive and arguments.pps is None:
+        parser.error('--adaptive needs a starting rate from --pps')
+    if arguments.top is not None and arguments.top < 1:
+        parser.error('--top must be at least 1')
+    if arguments.banners and arguments.protocol == UDP:
+        parser.error('--banners only works on TCP ports')
+    if arguments.history is None and (arguments.diff_since is not None or
+                                      arguments.incremental):
+        parser.error('--diff-since and --incremental need --history')
+    if not 0 < arguments.sample <= 1:
+        parser.error('--sample must be above 0 and at most 1')
+    if arguments.order is None:
+        arguments.order = 'numeric' if arguments.top is None else 'common'
+    ports = port_order(arguments.order, arguments.first, arguments.top)
+    checkpoint = None
+    if arguments.state is not None:
+        try:
+            checkpoint = Checkpoint(arguments.state, arguments.protocol,
+                                    ports, arguments.save_every)
+        except ValueError as error:
+            parser.error(str(error))
+    output = WRITERS[arguments.format](sys.stdout)
+    history = None
+    if arguments.history is not None:
+        output = history = History(
+            arguments.history, output, arguments.protocol, ports,
+            arguments.diff_since, arguments.incremental and arguments.sample)
+    if arguments.banners:
+        output = Fingerprinter(output, arguments.banner_limit,
+                               arguments.banner_timeout)
+    limiter = None
+    if arguments.pps or arguments.host_pps:
+        limiter = RateLimiter(arguments.pps, arguments.host_pps,
+                              arguments.adaptive)
+    hosts = expand(arguments.targets)
+    if arguments.family is not None:
+        hosts = bind_families(hosts, arguments.family)
+    scheduler = Scheduler(hosts, ports,
+                          arguments.per_host, arguments.limit, output,
+                          arguments.timeout, arguments.retries, checkpoint,
+                          limiter, history)
+    scan = ENGINES[arguments.engine]
+    try:
+        scan(scheduler, Resolver(arguments.ttl), arguments.limit,
+             arguments.protocol)
+    finally:
+        if arguments.banners:
+            output.close()
+        if checkpoint is not None:
+            checkpoint.save()
+        if history is not None:
+            history.close()
+
+
+def scan_pool(scheduler, resolver, limit, protocol=TCP):
+    """Probe with blocking connects in a process pool.
+
+    Hosts are looked up here, once per TTL, and each job carries the
+    addresses to its worker, so a host that cannot be resolved is given up
+    on before any of its ports are sent out. A probe that raises in its
+    worker counts as unanswered rather than leaving the scan waiting.
+    """
+    probe = test if protocol == TCP else query
+    silent = FILTERED if protocol == TCP else OPEN_FILTERED
+    outcomes = queue.SimpleQueue()
+    with multiprocessing.Pool(POOL_SIZE) as pool:
+        in_flight = 0
+        while True:
+            while in_flight < limit:
+                job = scheduler.next()
+                if job is None:
+                    break
+                try:
+                    infos = resolver(job[0])
+                except OSError as error:
+                    scheduler.abandon(job[0], error)
+                    continue
+                delay = scheduler.pace(job[0])
+                if delay:
+                    time.sleep(delay)
+                pool.apply_async(
+                    probe, [job, infos], callback=outcomes.put,
+                    error_callback=lambda _, job=job: outcomes.put(
+                        (silent, None, job)))
+                in_flight += 1
+            if not in_flight:
+                break
+            state, elapsed, (host, port, _) = outcomes.get()
+            in_flight -= 1
+            scheduler.done(host, port, state, elapsed)
+
+
+def scan_asyncio(scheduler, resolver, limit, protocol=TCP):
+    """Probe with non-blocking connects on one event loop."""
+    asyncio.run(sweep(scheduler, resolver, limit, protocol))
+
+
+def scan_sharded(scheduler, resolver, limit, protocol=TCP):
+    """Probe with one event loop per core, each in its own process.
+
+    The scheduler stays here and deals probes out in batches, each to
+    whichever worker has the fewest in flight, so the limit is shared evenly
+    and a slow host never holds up a whole shard. Workers send their results
+    back in batches as well, packed per host into a few bytes a probe.
+    """
+    shards = [Shard(resolver, protocol) for _ in range(min(cores(), limit))]
+    share = max(1, limit // len(shards))
+    results = {shard.results: shard for shard in shards}
+    try:
+        while True:
+            batches = collections.defaultdict(dict)
+            while True:
+                shard = min(shards, key=lambda shard: shard.in_flight)
+                if shard.in_flight >= share:
+                    break
+                job = scheduler.next()
+                if job is None:
+                    break
+                host, port, timeout = job
+                delay = scheduler.pace(host)
+                if delay:
+                    deal(batches)
+                    time.sleep(delay)
+                packed = batches[shard].setdefault(host, bytearray())
+                packed += JOB.pack(port, timeout)
+                shard.in_flight += 1
+            deal(batches)
+            if not any(shard.in_flight for shard in shards):
+                break
+            for connection in multiprocessing.connection.wait(results):
+                results[connection].collect(scheduler)
+    finally:
+        for shard in shards:
+            shard.close()
+
+
+class Shard:
+    """Run one worker process of the sharded engine and talk to it.
+
+    Probes go down one pipe and results come up another, each worker
+    sending from a thread of its own so neither side can block the other.
+    """
+
+    def __init__(self, resolver, protocol):
+        jobs, self.jobs = multiprocessing.Pipe(duplex=False)
+        self.results, results = multiprocessing.Pipe(duplex=False)
+        self.process = multiprocessing.Process(
+            target=serve_shard, args=[jobs, results, resolver, protocol],
+            daemon=True)
+        self.process.start()
+        jobs.close()
+        results.close()
+        self.in_flight = 0
+
+    def collect(self, scheduler):
+        """Pass a batch of results from the worker on to the scheduler."""
+        try:
+            outcomes, errors = self.results.recv()
+        except EOFError:
+            raise RuntimeError('a scan worker died') from None
+        for host, packed in outcomes.items():
+            for port, state, elapsed in RESULT.iter_unpack(packed):
+                self.in_flight -= 1
+                scheduler.done(host, port, STATES[state],
+                               None if elapsed < 0 else elapsed)
+        for host, error in errors:
+            self.in_flight -= 1
+            scheduler.abandon(host, error)
+
+    def close(self):
+        """Tell the worker to stop and wait until it has."""
+        try:
+            self.jobs.send(None)
+        except OSError:
+            pass
+        self.jobs.close()
+        self.results.close()
+        self.process.join()
+
+
+def deal(batches):
+    """Send every batch of probes to its worker and forget them."""
+    for shard, batch in batches.items():
+        shard.jobs.send(batch)
+    batches.clear()
+
+
+def cores():
+    """Count the cores this process may run on."""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def scan_epoll(scheduler, resolver, limit, protocol=TCP):
+    """Probe with non-blocking sockets straight on epoll, or poll without it.
+
+    Probes in flight live in preallocated slots whose fields are arrays, and
+    each poll hands back file numbers that map straight to slots, so a probe
+    costs little beyond its socket and its system calls. Lookups block the
+    loop, which is cheap for addresses and happens once per TTL for names.
+    The open file limit is raised to fit the limit where the hard limit
+    allows it; otherwise fewer probes are kept in flight.
+    """
+    size = fit_file_limit(limit)
+    if size < limit:
+        print(f'The open file limit leaves room for only {size} probes',
+              file=sys.stderr)
+    slots = Slots(size, scheduler, protocol)
+    held = None
+    try:
+        while True:
+            while slots.free:
+                if held is None:
+                    held = scheduler.next()
+                    if held is None:
+                        break
+                    release = time.perf_counter() + scheduler.pace(held[0])
+                if release > time.perf_counter():
+                    break
+                host, port, timeout = held
+                held = None
+                try:
+                    infos = resolver(host)
+                except OSError as error:
+                    scheduler.abandon(host, error)
+                    continue
+                slots.take(host, infos, port, timeout)
+            if held is None and len(slots.free) == size:
+                break
+            wake_at = min(slots.deadlines)
+            if held is not None:
+                wake_at = min(wake_at, release)
+            for fd, _ in slots.poll(max(0.0, wake_at - time.perf_counter())):
+                slots.answer(slots.slot_of[fd])
+            slots.expire(time.perf_counter())
+    finally:
+        slots.close()
+
+
+class Slots:
+    """Keep every probe in flight in fixed arrays indexed by slot number.
+
+    A host with several addresses has them tried one after another in the
+    same slot, and the port gets the most telling state of them all, as in
+    test(). Finished probes go straight to the scheduler.
+    """
+
+    def __init__(self, size, scheduler, protocol=TCP):
+        self.scheduler = scheduler
+        self.free = list(range(size))
+        self.sockets = [None] * size
+        self.hosts = [None] * size
+        self.infos = [None] * size
+        self.states = [None] * size
+        self.ports = array.array('H', bytes(2 * size))
+        self.tries = array.array('H', bytes(2 * size))
+        self.timeouts = array.array('d', bytes(8 * size))
+        self.started = array.array('d', bytes(8 * size))
+        self.elapsed = array.array('d', bytes(8 * size))
+        self.deadlines = array.array('d', [math.inf]) * size
+        self.slot_of = {}
+        self.udp = protocol == UDP
+        self.kind = socket.SOCK_DGRAM if self.udp else socket.SOCK_STREAM
+        self.silent = OPEN_FILTERED if self.udp else FILTERED
+        if hasattr(select, 'epoll'):
+            self.poller = select.epoll()
+            self.poll = self.poller.poll
+            self.event = select.EPOLLIN if self.udp else select.EPOLLOUT
+        else:
+            self.poller = select.poll()
+            self.poll = lambda timeout: self.poller.poll(timeout * 1000)
+            self.event = select.POLLIN if self.udp else select.POLLOUT
+
+    def take(self, host, infos, port, timeout):
+        """Start probing a port in a free slot."""
+        slot = self.free.pop()
+        self.hosts[slot] = host
+        self.infos[slot] = infos
+        self.states[slot] = self.silent
+        self.ports[slot] = port
+        self.tries[slot] = 0
+        self.timeouts[slot] = timeout
+        self.elapsed[slot] = -1.0
+        self.launch(slot)
 
+    def launch(self, slot):
+        """Open a socket to the address the slot is at and send the probe."""
+        info = self.infos[slot][self.tries[slot]]
+        try:
+            probe = socket.socket(info.family, self.kind)
+        except OSError as error:
+            self.end(slot, self.outcome(error.errno))
+            return
+        probe.setblocking(False)
+        self.started[slot] = time.perf_counter()
+        address = locate(info, self.ports[slot])
+        if self.udp:
+            try:
+                probe.connect(address)
+                probe.send(PAYLOADS.get(self.ports[slot], b''))
+            except OSError as error:
+                failure = error.errno
+            else:
+                failure = None
+        else:
+            failure = probe.connect_ex(address)
+            if failure in IN_PROGRESS:
+                failure = None
+        if failure is not None:
+            probe.close()
+            self.end(slot, self.outcome(failure))
+            return
+        self.sockets[slot] = probe
+        self.slot_of[probe.fileno()] = slot
+        self.poller.register(probe, self.event)
+        self.deadlines[slot] = self.started[slot] + self.timeouts[slot]
+
+    def answer(self, slot):
+        """Find out what became of a probe the poller says is ready."""
+        probe = self.sockets[slot]
+        if self.udp:
+            try:
+                probe.recv(DATAGRAM_SIZE)
+            except BlockingIOError:
+                return
+            except OSError as error:
+                self.end(slot, self.outcome(error.errno))
+                return
+            error = 0
+        else:
+            error = probe.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error == 0 and not talks_to_itself(probe):
+            self.end(slot, OPEN)
+        else:
+            self.end(slot, self.outcome(error or errno.ECONNREFUSED))
+
+    def expire(self, now):
+        """End every probe whose deadline has passed."""
+        if min(self.deadlines) > now:
+            return
+        for slot, deadline in enumerate(self.deadlines):
+            if deadline <= now:
+                self.end(slot, self.silent)
+
+    def outcome(self, error):
+        """Tell the state of a port from the error its probe ended with."""
+        if error == errno.ECONNREFUSED:
+            return CLOSED
+        if error in CONGESTION:
+            return BUSY
+        return self.silent
+
+    def end(self, slot, state):
+        """Close the current try of a slot, then try on or report the port."""
+        probe = self.sockets[slot]
+        if probe is not None:
+            self.sockets[slot] = None
+            del self.slot_of[probe.fileno()]
+            self.poller.unregister(probe)
+            probe.close()
+        self.deadlines[slot] = math.inf
+        if state == OPEN:
+            self.report(slot, OPEN, time.perf_counter() - self.started[slot])
+            return
+        if state == CLOSED:
+            self.states[slot] = CLOSED
+            self.elapsed[slot] = time.perf_counter() - self.started[slot]
+        elif state == BUSY and self.states[slot] == self.silent:
+            self.states[slot] = BUSY
+        if self.tries[slot] + 1 < len(self.infos[slot]):
+            self.tries[slot] += 1
+            self.launch(slot)
+        else:
+            elapsed = self.elapsed[slot]
+            self.report(slot, self.states[slot],
+                        None if elapsed < 0 else elapsed)
+
+    def report(self, slot, state, elapsed):
+        """Pass the state of a port to the scheduler and free its slot."""
+        host = self.hosts[slot]
+        self.hosts[slot] = self.infos[slot] = None
+        self.free.append(slot)
+        self.scheduler.done(host, self.ports[slot], state, elapsed)
+
+    def close(self):
+        """Close every socket still open and the poller."""
+        for probe in self.sockets:
+            if probe is not None:
+                probe.close()
+        self.poller.close()
+
+
+def fit_file_limit(wanted):
+    """Raise the open file limit to fit wanted sockets and say how many fit."""
+    if resource is None:
+        return wanted
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    needed = wanted + SPARE_FILES
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        if hard != resource.RLIM_INFINITY:
+            needed = min(needed, hard)
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (needed, hard))
+        except (ValueError, OSError):
+            pass
+        soft = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    if soft == resource.RLIM_INFINITY:
+        return wanted
+    return max(1, min(wanted, soft - SPARE_FILES))
+
+
+ENGINES = dict(pool=scan_pool, asyncio=scan_asyncio, sharded=scan_sharded,
+               epoll=scan_epoll)
 
 field_names = 'family', 'socket_type', 'protocol', 'canon_name', 'address'
 AddressInfo = collections.namedtuple('AddressInfo', field_names)
 del field_names
 
 
-def test(address):
-    """Try connecting to the server and return whether or not it succeeded."""
-    host, port = address
-    for info in itertools.starmap(AddressInfo, socket.getaddrinfo(host, port)):
+class Resolver:
+    """Remember the stream addresses of each host for a limited time."""
+
+    def __init__(self, ttl=TTL):
+        self.ttl = ttl
+        self.entries = {}
+
+    def __call__(self, host):
+        """Return the addresses of host, looking them up if they expired."""
+        if self.expired(host):
+            return self.refresh(host)
+        return self.entries[host][1]
+
+    def expired(self, host):
+        """Tell whether host has never been resolved or its entry is stale."""
+        entry = self.entries.get(host)
+        return entry is None or entry[0] <= time.monotonic()
+
+    def hold(self, host):
+        """Keep serving a stale entry for another TTL while it is refreshed."""
+        self.entries[host] = time.monotonic() + self.ttl, self.entries[host][1]
+
+    def refresh(self, host):
+        """Look up host now and cache the result for the next TTL."""
+        infos = resolve(host)
+        self.entries[host] = time.monotonic() + self.ttl, infos
+        return infos
+
+
+def resolve(host):
+    """Get every stream address of host independent of any port."""
+    name, version = untag(host)
+    infos = socket.getaddrinfo(name, 0, VERSIONS.get(version, 0),
+                               socket.SOCK_STREAM)
+    return list(itertools.starmap(AddressInfo, infos))
+
+
+def bind_families(hosts, family):
+    """Tag each host with the IP version to scan it over.
+
+    Both versions turn a name into two hosts, one per family, that are
+    scanned side by side and reported apart, while a literal address keeps
+    to its own. A tagged host looks like ipv6:example.com.
+    """
+    for host in hosts:
+        if family != 'both':
+            yield f'ipv{family}:{host}'
+        elif is_address(host):
+            yield f'ipv{ipaddress.ip_address(host).version}:{host}'
+        else:
+            yield from (tag + host for tag in TAGS)
+
+
+def untag(host):
+    """Split a host into its name and the IP version it is bound to, if any."""
+    if host.startswith(TAGS):
+        return host[len(TAGS[0]):], int(host[3])
+    return host, None
+
+
+def label(host):
+    """Name a host for people, with the IP version it is bound to, if any."""
+    name, version = untag(host)
+    return name if version is None else f'{name} over IPv{version}'
+
+
+def locate(info, port):
+    """Build the socket address for port from a resolved address."""
+    return info.address[:1] + (port,) + info.address[2:]
+
+
+def expand(specs):
+    """Turn target arguments into the individual hosts they name."""
+    for spec in specs:
+        if spec.startswith('@'):
+            with open(spec[1:]) as file:
+                lines = (line.split('#', 1)[0].strip() for line in file)
+                yield from expand(filter(None, lines))
+        elif '/' in spec:
+            network = ipaddress.ip_network(spec, strict=False)
+            yield from map(str, network.hosts())
+        elif '-' in spec and is_address(spec.split('-', 1)[0]):
+            yield from span(*spec.split('-', 1))
+        else:
+            yield spec
+
+
+def is_address(text):
+    """Tell whether text is a literal IP address rather than a name."""
+    try:
+        ipaddress.ip_address(text)
+    except ValueError:
+        return False
+    return True
+
+
+def span(first, last):
+    """Yield every address from first to last, inclusive.
+
+    The end of the range may be a whole address or, as a shorthand, just the
+    final part of one, so 10.0.0.1-254 and 10.0.0.1-10.0.0.254 are the same.
+    """
+    start = ipaddress.ip_address(first)
+    if not is_address(last):
+        separator = '.' if start.version == 4 else ':'
+        last = first.rsplit(separator, 1)[0] + separator + last
+    stop = ipaddress.ip_address(last)
+    for number in range(int(start), int(stop) + 1):
+        yield str(ipaddress.ip_address(number))
+
+
+def port_list(text):
+    """Parse ports like 22,80,8000-8100 into a list in the order given."""
+    ports = []
+    try:
+        for part in filter(None, text.split(',')):
+            first, _, last = part.partition('-')
+            ports.extend(range(int(first), int(last or first) + 1))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid port list: {text!r}')
+    if not all(port in PORTS for port in ports):
+        raise argparse.ArgumentTypeError(f'ports must be in {PORTS}')
+    return ports
+
+
+def port_order(order, first=(), top=None):
+    """List every port to probe, in the order to probe them.
+
+    Ports given in first come before everything else. The common order then
+    follows the bundled TOP_PORTS table, ranked by how often each port is
+    found open, with the well-known ports that have a service name next and
+    the rest numerically. Only the first top ports are kept if top is set.
+    """
+    ranked = itertools.chain(first, ORDERS[order](), PORTS)
+    return list(dict.fromkeys(ranked))[:top]
+
+
+def common_ports():
+    """Yield the most often open ports and then the named well-known ones."""
+    yield from TOP_PORTS
+    for port in WELL_KNOWN:
         try:
-            probe = socket.socket(info.family, info.socket_type, info.protocol)
+            socket.getservbyport(port, 'tcp')
         except OSError:
-            pass
+            continue
+        yield port
+
+
+ORDERS = dict(numeric=tuple, common=common_ports)
+
+
+class RoundTrip:
+    """Estimate how long to wait for a host the way TCP derives its RTO.
+
+    Until a few connects have been answered the initial timeout is used; after
+    that the timeout is the smoothed round trip plus four times its variation
+    (RFC 6298), kept between MIN_TIMEOUT and MAX_TIMEOUT.
+    """
+
+    def __init__(self, initial):
+        self.initial = initial
+        self.samples = 0
+        self.smoothed = self.variation = 0.0
+
+    def add(self, elapsed):
+        """Fold the round trip of an answered connect into the estimate."""
+        if self.samples:
+            self.variation += (abs(self.smoothed - elapsed) -
+                               self.variation) / 4
+            self.smoothed += (elapsed - self.smoothed) / 8
+        else:
+            self.smoothed, self.variation = elapsed, elapsed / 2
+        self.samples += 1
+
+    @property
+    def timeout(self):
+        """Get the time to wait for the next connect to this host."""
+        if self.samples < SAMPLES:
+            return self.initial
+        estimate = self.smoothed + 4 * self.variation
+        return min(max(estimate, MIN_TIMEOUT), MAX_TIMEOUT)
+
+
+class Target:
+    """Track the ports of one host that are pending, in flight, and open."""
+
+    def __init__(self, host, ports, timeout):
+        self.host = host
+        self.total = len(ports)
+        self.pending = iter(ports)
+        self.retry = collections.deque()
+        self.failures = collections.Counter()
+        self.timer = RoundTrip(timeout)
+        self.in_flight = 0
+        self.bucket = None
+        self.servers = []
+        self.services = {}
+        self.silent = 0
+        self.error = None
+        self.exhausted = False
+        self.share = 0
+
+
+class Scheduler:
+    """Interleave probes across hosts and pass what they find to the output.
+
+    Each host has at most per_host probes in flight, and hosts are opened
+    only until the probes they could have in flight add up to limit, so a
+    sweep over a large block touches every host gently and still reports
+    finished hosts early instead of all at once at the end. A host stops
+    counting once all its ports are handed out, even while its last probes
+    wait out their timeouts. Ports that go unanswered are probed again, up
+    to retries times, with the host's timeout backed off for each earlier
+    failure. Given a checkpoint, ports it already holds are skipped and new
+    outcomes go to it.
+    Given a rate limiter, pace() says how long to hold each probe back, and
+    probes that failed for lack of local resources are queued again. Given
+    a history, each host is probed on the ports its plan() lists.
+    """
+
+    def __init__(self, hosts, ports, per_host, limit, output,
+                 timeout=TIMEOUT, retries=RETRIES, checkpoint=None,
+                 limiter=None, history=None):
+        self.hosts = iter(hosts)
+        self.ports = ports
+        self.per_host = per_host
+        self.limit = limit
+        self.output = output
+        self.timeout = timeout
+        self.retries = retries
+        self.checkpoint = checkpoint
+        self.limiter = limiter
+        self.history = history
+        self.open = {}
+        self.active = collections.deque()
+        self.demand = 0
+
+    @property
+    def drained(self):
+        """Tell whether every probe that will ever exist was handed out."""
+        return self.hosts is None and not self.active
+
+    def next(self):
+        """Hand out the next (host, port, timeout) or None if none is ready."""
+        self.admit()
+        checked = 0
+        while checked < len(self.active):
+            target = self.active.popleft()
+            if target.in_flight >= self.per_host:
+                self.active.append(target)
+                checked += 1
+                continue
+            timeout = target.timer.timeout
+            if target.retry:
+                port = target.retry.popleft()
+                timeout *= BACKOFF ** target.failures[port]
+            else:
+                port = next(target.pending, None)
+            if port is None:
+                target.exhausted = True
+                self.demand -= target.share
+                if not target.in_flight:
+                    self.finish(target)
+                self.admit()
+                continue
+            self.active.append(target)
+            target.in_flight += 1
+            return target.host, port, timeout
+        return None
+
+    def done(self, host, port, state, elapsed):
+        """Record the state of a probed port and how long the answer took."""
+        target = self.open.get(host)
+        if target is None:
+            return
+        target.in_flight -= 1
+        if state == OPEN:
+            target.servers.append(port)
+            self.output.found(host, port, elapsed)
+        if elapsed is not None:
+            target.timer.add(elapsed)
+        if self.limiter is not None:
+            self.limiter.observe(state)
+        if state == BUSY or (state in SILENT and
+                             target.failures[port] < self.retries):
+            if state in SILENT:
+                target.failures[port] += 1
+            target.retry.append(port)
+            if target.exhausted:
+                target.exhausted = False
+                self.active.append(target)
+                self.demand += target.share
+        else:
+            if state == OPEN_FILTERED:
+                target.silent += 1
+            if self.checkpoint is not None:
+                self.checkpoint.mark(host, port, state == OPEN)
+            if target.exhausted and not target.in_flight:
+                self.finish(target)
+
+    def pace(self, host):
+        """Get the seconds to wait before sending a probe to host."""
+        if self.limiter is None:
+            return 0.0
+        return self.limiter.delay(self.open[host].bucket)
+
+    def abandon(self, host, error):
+        """Give up on a host that cannot be scanned and report why."""
+        target = self.open.get(host)
+        if target is None:
+            return
+        target.error = error
+        if target in self.active:
+            self.active.remove(target)
+            self.demand -= target.share
+        self.finish(target)
+
+    def admit(self):
+        """Open new hosts until their ports fill the limit or none are left."""
+        while self.hosts is not None and self.demand < self.limit:
+            host = next(self.hosts, None)
+            if host is None:
+                self.hosts = None
+            elif host not in self.open:
+                self.open[host] = target = self.resume(host)
+                if self.limiter is not None:
+                    target.bucket = self.limiter.host_bucket()
+                target.share = min(self.per_host, target.total)
+                self.active.append(target)
+                self.demand += target.share
+
+    def resume(self, host):
+        """Start a host, leaving out whatever the checkpoint already has."""
+        ports = self.ports
+        if self.history is not None:
+            ports = self.history.plan(host)
+        if self.checkpoint is not None and host in self.checkpoint.done:
+            target = Target(host, (), self.timeout)
+            target.servers.extend(self.checkpoint.done[host])
+            return target
+        if self.checkpoint is None or host not in self.checkpoint.hosts:
+            return Target(host, ports, self.timeout)
+        probed, servers = self.checkpoint.hosts[host]
+        pending = [port for port in ports if not has(probed, port)]
+        target = Target(host, pending, self.timeout)
+        target.servers.extend(members(servers))
+        return target
+
+    def finish(self, target):
+        """Close a host and pass it to the output."""
+        del self.open[target.host]
+        if self.checkpoint is not None and target.error is None:
+            self.checkpoint.finish(target.host, target.servers)
+        self.output.finished(target)
+
+
+class History:
+    """Keep the results of every scan in SQLite and compare hosts with them.
+
+    Wraps an output. Each open port found gets a row keyed by host, family,
+    protocol, port and the time the scan started, and so does each port
+    known to be open that was probed and found closed, so the latest row of
+    a port holds its last known state. Given since, a finished host is
+    passed on only as the ports that opened or closed since then. Given a
+    sample share, hosts are planned incrementally: known open ports first,
+    then that share of the others, picked at random.
+    """
+
+    def __init__(self, path, output, protocol, ports, since=None,
+                 sample=None):
+        self.output = output
+        self.protocol = protocol
+        self.ports = ports
+        self.scanned = set(ports)
+        self.since = since
+        self.sample = sample
+        self.time = time.time()
+        self.known = {}
+        self.baseline = {}
+        self.probed = {}
+        self.latencies = {}
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode = WAL')
+        with self.db:
+            self.db.executescript(SCHEMA)
+            self.db.execute('INSERT INTO scans VALUES (?, ?, ?)',
+                            (self.time, protocol, len(ports)))
+
+    def plan(self, host):
+        """List the ports to probe on host and look up what it had open."""
+        name, version = untag(host)
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT port, state, time FROM ports WHERE host = ? AND '
+                'family = ? AND protocol = ? ORDER BY time',
+                (name, version or 0, self.protocol)).fetchall()
+        known, baseline = {}, {}
+        for port, state, stamp in rows:
+            known[port] = state
+            if self.since is not None and stamp <= self.since:
+                baseline[port] = state
+        self.known[host] = {port for port, state in known.items()
+                            if state == OPEN}
+        self.baseline[host] = {port for port, state in baseline.items()
+                               if state == OPEN}
+        if not self.sample:
+            return self.ports
+        rest = [port for port in self.ports if port not in self.known[host]]
+        picked = set(random.sample(rest, math.ceil(len(rest) * self.sample)))
+        plan = sorted(self.known[host]) + [port for port in rest
+                                           if port in picked]
+        self.probed[host] = set(plan)
+        return plan
+
+    def found(self, host, port, elapsed, service=None):
+        """Note how fast an open port answered; pass it on unless diffing."""
+        self.latencies.setdefault(host, {})[port] = elapsed
+        if self.since is None:
+            self.output.found(host, port, elapsed, service)
+
+    def finished(self, target):
+        """Store what a host had open and pass it, or its changes, on."""
+        host = target.host
+        known = self.known.pop(host, set())
+        baseline = self.baseline.pop(host, set())
+        probed = self.probed.pop(host, self.scanned)
+        latencies = self.latencies.pop(host, {})
+        if target.error is not None:
+            self.output.finished(target)
+            return
+        name, version = untag(host)
+        servers = set(target.servers)
+        rows = [(name, version or 0, self.protocol, port, self.time, OPEN,
+                 latencies.get(port), target.services.get(port))
+                for port in sorted(servers)]
+        rows += [(name, version or 0, self.protocol, port, self.time, CLOSED,
+                  None, None) for port in sorted(known & probed - servers)]
+        with self.lock, self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO ports VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                rows)
+        if self.since is None:
+            self.output.finished(target)
+        else:
+            self.output.changed(target, sorted(servers - baseline),
+                                sorted(baseline & probed - servers))
+
+    def close(self):
+        """Close the store."""
+        self.db.close()
+
+
+def moment(text):
+    """Parse last, an age like 36h, or an ISO time into seconds since 1970."""
+    if text == 'last':
+        return time.time()
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)([smhd])', text)
+    if match:
+        return time.time() - float(match[1]) * UNITS[match[2]]
+    try:
+        return datetime.datetime.fromisoformat(text).timestamp()
+    except ValueError:
+        message = f'not a time or age: {text}'
+        raise argparse.ArgumentTypeError(message) from None
+
+
+class TokenBucket:
+    """Hand out tokens at rate per second, saving up at most burst of them.
+
+    Taking a token never blocks; the bucket may go into debt and the caller
+    is told how long to wait, so concurrent callers line up at the rate.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1.0, rate * BURST)
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+
+    def reserve(self):
+        """Take a token and return the seconds to wait before using it."""
+        self.refill()
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def refill(self):
+        """Add the tokens earned since the last call."""
+        now = time.monotonic()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def adjust(self, rate):
+        """Change the rate from now on."""
+        self.refill()
+        self.rate = rate
+        self.burst = max(1.0, rate * BURST)
+
+
+class RateLimiter:
+    """Pace probes with one token bucket for the scan and one per host.
+
+    In adaptive mode the global rate is halved, at most once a second,
+    whenever a connect fails for lack of local buffers or ports or the
+    share of timeouts suddenly jumps above its long-run level. It then
+    recovers linearly and reaches the configured rate again RECOVERY
+    seconds later.
+    """
+
+    def __init__(self, rate=None, host_rate=None, adaptive=False):
+        self.bucket = TokenBucket(rate) if rate else None
+        self.host_rate = host_rate
+        self.adaptive = adaptive
+        self.ceiling = rate
+        self.fast = self.slow = 0.0
+        self.stamp = self.cut = time.monotonic()
+
+    def host_bucket(self):
+        """Make the bucket for a newly opened host, if hosts have a rate."""
+        return TokenBucket(self.host_rate) if self.host_rate else None
+
+    def delay(self, bucket):
+        """Take a token from the scan and the host and say how long to wait."""
+        waits = [each.reserve() for each in (self.bucket, bucket)
+                 if each is not None]
+        return max(waits, default=0.0)
+
+    def observe(self, state):
+        """Adapt the rate to the outcome of a probe."""
+        if not self.adaptive:
+            return
+        timed_out = state in SILENT
+        self.fast += (timed_out - self.fast) / 16
+        self.slow += (timed_out - self.slow) / 256
+        now = time.monotonic()
+        if state == BUSY or self.fast > 2 * self.slow + 0.1:
+            if now - self.cut >= 1:
+                self.cut = now
+                self.bucket.adjust(max(MIN_RATE, self.bucket.rate / 2))
+        elif self.bucket.rate < self.ceiling:
+            gain = (now - self.stamp) * self.ceiling / RECOVERY
+            self.bucket.adjust(min(self.ceiling, self.bucket.rate + gain))
+        self.stamp = now
+
+
+class Checkpoint:
+    """Journal the ports probed and found open per host in a state file.
+
+    The file is a short header, naming the protocol and a checksum of the
+    ports to probe, followed by zlib-compressed chunks, one per save, each
+    prefixed with its length. A chunk holds a record per host with the ports
+    that were probed and found open since the last save, and a record per
+    host that finished with just its open ports. Saving appends only what
+    changed, so its cost does not grow with the hosts already scanned; a
+    chunk cut short by a crash is ignored. Loading folds the records into
+    two 8 KiB bitmaps per unfinished host and rewrites the file compactly.
+    A file saved by a scan of another protocol or other ports is refused.
+    """
+
+    def __init__(self, path, protocol, ports, interval=SAVE_EVERY):
+        self.path = path
+        self.interval = interval
+        plan = zlib.crc32(array.array('H', ports).tobytes())
+        self.header = MAGIC + f'{protocol} {plan:08x}\n'.encode()
+        self.hosts = {}
+        self.done = {}
+        self.fresh = {}
+        self.finished = []
+        self.saved = time.monotonic()
+        if os.path.exists(path):
+            self.load()
+        self.compact()
+
+    def load(self):
+        """Replay the journal saved by an earlier run."""
+        with open(self.path, 'rb') as file:
+            if file.read(len(MAGIC)) != MAGIC:
+                raise ValueError(
+                    f'{self.path} is not a portscanner state file')
+            if MAGIC + file.readline() != self.header:
+                raise ValueError(f'{self.path} was saved by a scan of '
+                                 f'another protocol or other ports')
+            while True:
+                size = file.read(CHUNK.size)
+                if len(size) < CHUNK.size:
+                    break
+                data = file.read(CHUNK.unpack(size)[0])
+                try:
+                    self.replay(memoryview(zlib.decompress(data)))
+                except zlib.error:
+                    break
+
+    def replay(self, body):
+        """Fold the records of a chunk into the bitmaps and finished hosts."""
+        offset = 0
+        while offset < len(body):
+            kind, size, probed, found = RECORD.unpack_from(body, offset)
+            offset += RECORD.size
+            host = bytes(body[offset:offset + size]).decode()
+            offset += size
+            ports = struct.unpack_from(f'>{probed + found}H', body, offset)
+            offset += 2 * (probed + found)
+            if kind == b'd':
+                self.hosts.pop(host, None)
+                self.done[host] = ports
+                continue
+            if host not in self.hosts:
+                self.hosts[host] = bytearray(BITMAP), bytearray(BITMAP)
+            for bitmap, marked in zip(self.hosts[host],
+                                      (ports[:probed], ports[probed:])):
+                for port in marked:
+                    bitmap[port >> 3] |= 1 << (port & 7)
+
+    def mark(self, host, port, is_open):
+        """Note that port has been probed and whether it was open."""
+        probed, servers = self.fresh.setdefault(host, ([], []))
+        probed.append(port)
+        if is_open:
+            servers.append(port)
+        if time.monotonic() - self.saved >= self.interval:
+            self.save()
+
+    def finish(self, host, servers):
+        """Note that every port of host has been probed."""
+        if host not in self.done:
+            self.hosts.pop(host, None)
+            self.fresh.pop(host, None)
+            self.done[host] = tuple(servers)
+            self.finished.append(host)
+
+    def save(self):
+        """Append what changed since the last save to the file."""
+        records = [entry(b'p', host, probed, servers)
+                   for host, (probed, servers) in self.fresh.items()]
+        records += [entry(b'd', host, (), self.done[host])
+                    for host in self.finished]
+        self.fresh, self.finished = {}, []
+        if records:
+            data = zlib.compress(b''.join(records))
+            with open(self.path, 'ab') as file:
+                file.write(CHUNK.pack(len(data)) + data)
+                file.flush()
+                os.fsync(file.fileno())
+        self.saved = time.monotonic()
+
+    def compact(self):
+        """Write what is known as one chunk and swap it into place."""
+        records = [entry(b'p', host, list(members(probed)),
+                         list(members(servers)))
+                   for host, (probed, servers) in self.hosts.items()]
+        records += [entry(b'd', host, (), servers)
+                    for host, servers in self.done.items()]
+        temporary = f'{self.path}.tmp'
+        with open(temporary, 'wb') as file:
+            file.write(self.header)
+            if records:
+                data = zlib.compress(b''.join(records))
+                file.write(CHUNK.pack(len(data)) + data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, self.path)
+
+
+def entry(kind, host, probed, servers):
+    """Pack the probed and open ports of a host into a journal record."""
+    name = host.encode()
+    ports = (*probed, *servers)
+    return (RECORD.pack(kind, len(name), len(probed), len(servers)) + name +
+            struct.pack(f'>{len(ports)}H', *ports))
+
+
+BITMAP = len(PORTS) >> 3
+
+
+def has(bitmap, port):
+    """Tell whether the bit for port is set."""
+    return bitmap[port >> 3] >> (port & 7) & 1
+
+
+def members(bitmap):
+    """Yield every port whose bit is set, skipping empty bytes quickly."""
+    for match in re.finditer(rb'[^\x00]', bitmap):
+        index, byte = match.start(), bitmap[match.start()]
+        for bit in range(8):
+            if byte >> bit & 1:
+                yield index << 3 | bit
+
+
+def test(job, infos):
+    """Try connecting to the server and return what happened and how fast.
+
+    Tries each of the host's resolved addresses in infos and gives back the
+    state of the port, the round trip of the answer that decided it (None if
+    nothing answered in time), and the job itself.
+    """
+    _, port, timeout = job
+    state, elapsed = FILTERED, None
+    for info in infos:
+        try:
+            probe = socket.socket(info.family, info.socket_type, info.protocol)
+        except OSError as error:
+            if error.errno in CONGESTION and state == FILTERED:
+                state = BUSY
         else:
             try:
-                probe.connect(info.address)
-            except OSError:
-                pass
+                probe.settimeout(timeout)
+                started = time.perf_counter()
+                probe.connect(locate(info, port))
+            except ConnectionRefusedError:
+                state, elapsed = CLOSED, time.perf_counter() - started
+            except OSError as error:
+                if error.errno in CONGESTION and state == FILTERED:
+                    state = BUSY
             else:
-                probe.shutdown(socket.SHUT_RDWR)
-                return True, port
+                if talks_to_itself(probe):
+                    state, elapsed = CLOSED, time.perf_counter() - started
+                    continue
+                elapsed = time.perf_counter() - started
+                try:
+                    probe.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                return OPEN, elapsed, job
             finally:
                 probe.close()
-    return False, port
+    return state, elapsed, job
+
+
+def talks_to_itself(probe):
+    """Tell if a loopback connect picked the port it was aimed at as its own.
 
+    Nothing listens there; the socket opened simultaneously with itself.
+    """
+    try:
+        return probe.getsockname() == probe.getpeername()
+    except OSError:
+        return False
 
-def format_ports(ports):
-    """Convert port numbers into strings and show all associated services."""
+
+def query(job, infos):
+    """Send the port a datagram and return what came back and how fast.
+
+    Works like test(), but over a connected UDP socket, so an ICMP port
+    unreachable in answer turns up as a refused receive.
+    """
+    _, port, timeout = job
+    state, elapsed = OPEN_FILTERED, None
+    for info in infos:
+        try:
+            probe = socket.socket(info.family, socket.SOCK_DGRAM)
+        except OSError as error:
+            if error.errno in CONGESTION and state == OPEN_FILTERED:
+                state = BUSY
+            continue
+        with probe:
+            try:
+                probe.settimeout(timeout)
+                started = time.perf_counter()
+                probe.connect(locate(info, port))
+                probe.send(PAYLOADS.get(port, b''))
+                probe.recv(DATAGRAM_SIZE)
+            except ConnectionRefusedError:
+                state, elapsed = CLOSED, time.perf_counter() - started
+            except OSError as error:
+                if error.errno in CONGESTION and state == OPEN_FILTERED:
+                    state = BUSY
+            else:
+                if talks_to_itself(probe):
+                    state, elapsed = CLOSED, time.perf_counter() - started
+                    continue
+                return OPEN, time.perf_counter() - started, job
+    return state, elapsed, job
+
+
+async def sweep(scheduler, resolver, limit, protocol=TCP):
+    """Run limit workers that take probes from the scheduler until drained.
+
+    A worker that finds every open host at its per-host cap parks on a future
+    and is woken by the next completion, or all at once when a host finishes
+    or nothing is left to hand out. A worker that gets a probe wakes one more,
+    so room that opens up without a completion is filled as well. Workers
+    yield after every probe, since a connect refused at once never suspends
+    and would otherwise starve the others. Datagrams are all sent and
+    received on the same loop, so each of its polls collects the replies and
+    refusals of every probe in flight at once.
+    """
+    loop = asyncio.get_running_loop()
+    resolving, waiting = {}, collections.deque()
+    exchange = attempt if protocol == TCP else ask
+
+    async def worker():
+        while True:
+            probe = scheduler.next()
+            if probe is None:
+                if scheduler.drained:
+                    while waiting:
+                        wake(waiting.popleft())
+                    return
+                waiting.append(loop.create_future())
+                await waiting[-1]
+                continue
+            host, port, timeout = probe
+            if waiting:
+                wake(waiting.popleft())
+            delay = scheduler.pace(host)
+            if delay:
+                await asyncio.sleep(delay)
+            try:
+                state, elapsed = await exchange(loop, host, port, timeout,
+                                                resolver, resolving)
+            except OSError as error:
+                scheduler.abandon(host, error)
+            else:
+                scheduler.done(host, port, state, elapsed)
+            if host not in scheduler.open:
+                while waiting:
+                    wake(waiting.popleft())
+            elif waiting:
+                wake(waiting.popleft())
+            await asyncio.sleep(0)
+
+    await asyncio.gather(*(worker() for _ in range(limit)))
+
+
+async def attempt(loop, host, port, timeout, resolver, resolving):
+    """Connect without blocking the loop and give the state and round trip."""
+    state, elapsed = FILTERED, None
+    for info in await lookup(loop, resolver, host, resolving):
+        try:
+            probe = socket.socket(info.family, info.socket_type, info.protocol)
+        except OSError as error:
+            if error.errno in CONGESTION and state == FILTERED:
+                state = BUSY
+            continue
+        try:
+            started = time.perf_counter()
+            error = await connect(loop, probe, locate(info, port), timeout)
+            if error == 0 and talks_to_itself(probe):
+                error = errno.ECONNREFUSED
+        finally:
+            probe.close()
+        if error == 0:
+            return OPEN, time.perf_counter() - started
+        if error == errno.ECONNREFUSED:
+            state, elapsed = CLOSED, time.perf_counter() - started
+        elif error in CONGESTION and state == FILTERED:
+            state = BUSY
+    return state, elapsed
+
+
+def serve_shard(jobs, results, resolver, protocol):
+    """Run a worker of the sharded engine until the parent says to stop."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(probe_shard(jobs, results, resolver, protocol))
+
+
+async def probe_shard(jobs, results, resolver, protocol):
+    """Probe every batch that comes down jobs and send the outcomes back.
+
+    Outcomes are sent once per turn of the loop, so one batch carries all
+    the probes that ended in the same poll.
+    """
+    loop = asyncio.get_running_loop()
+    exchange = attempt if protocol == TCP else ask
+    resolving, probes = {}, set()
+    outcomes, errors = {}, []
+    hung_up = loop.create_future()
+    sender = concurrent.futures.ThreadPoolExecutor(1)
+
+    def flush():
+        nonlocal outcomes, errors
+        sender.submit(results.send, (outcomes, errors))
+        outcomes, errors = {}, []
+
+    async def probe(host, port, timeout):
+        try:
+            state, elapsed = await exchange(loop, host, port, timeout,
+                                            resolver, resolving)
+        except OSError as error:
+            state = error
+        if not outcomes and not errors:
+            loop.call_soon(flush)
+        if isinstance(state, OSError):
+            errors.append((host, state))
+        else:
+            packed = outcomes.setdefault(host, bytearray())
+            packed += RESULT.pack(port, STATES.index(state),
+                                  -1.0 if elapsed is None else elapsed)
+
+    def receive():
+        try:
+            batch = jobs.recv()
+        except EOFError:
+            batch = None
+        if batch is None:
+            wake(hung_up)
+            return
+        for host, packed in batch.items():
+            for port, timeout in JOB.iter_unpack(packed):
+                task = loop.create_task(probe(host, port, timeout))
+                probes.add(task)
+                task.add_done_callback(probes.discard)
+
+    loop.add_reader(jobs.fileno(), receive)
+    try:
+        await hung_up
+    finally:
+        loop.remove_reader(jobs.fileno())
+        for task in probes:
+            task.cancel()
+        sender.shutdown()
+
+
+async def ask(loop, host, port, timeout, resolver, resolving):
+    """Send a datagram without blocking the loop and return what came back."""
+    state, elapsed = OPEN_FILTERED, None
+    for info in await lookup(loop, resolver, host, resolving):
+        try:
+            probe = socket.socket(info.family, socket.SOCK_DGRAM)
+        except OSError as error:
+            if error.errno in CONGESTION and state == OPEN_FILTERED:
+                state = BUSY
+            continue
+        with probe:
+            probe.setblocking(False)
+            started = time.perf_counter()
+            try:
+                probe.connect(locate(info, port))
+                probe.send(PAYLOADS.get(port, b''))
+                if await readable(loop, probe, timeout):
+                    probe.recv(DATAGRAM_SIZE)
+                    if talks_to_itself(probe):
+                        raise ConnectionRefusedError
+                    return OPEN, time.perf_counter() - started
+            except ConnectionRefusedError:
+                state, elapsed = CLOSED, time.perf_counter() - started
+            except OSError as error:
+                if error.errno in CONGESTION and state == OPEN_FILTERED:
+                    state = BUSY
+    return state, elapsed
+
+
+async def readable(loop, probe, timeout):
+    """Wait for a datagram or an error on probe and tell if one arrived."""
+    ready = loop.create_future()
+    loop.add_reader(probe, wake, ready, True)
+    timer = loop.call_later(timeout, wake, ready, False)
+    try:
+        return await ready
+    finally:
+        timer.cancel()
+        loop.remove_reader(probe)
+
+
+async def lookup(loop, resolver, host, resolving):
+    """Get the addresses of host, refreshing them off the loop when stale.
+
+    The first probe to notice an expired entry refreshes it in a thread while
+    every other probe keeps using the old addresses, so a TTL expiry costs one
+    lookup instead of one per port in flight. Probes of a host seen for the
+    first time share the lookup already running for it.
+    """
+    if not resolver.expired(host):
+        return resolver.entries[host][1]
+    if host in resolving:
+        return await resolving[host]
+    if host in resolver.entries:
+        resolver.hold(host)
+    resolving[host] = loop.run_in_executor(None, resolver.refresh, host)
+    try:
+        return await resolving[host]
+    finally:
+        del resolving[host]
+
+
+async def connect(loop, probe, address, timeout):
+    """Start a non-blocking connect and return its error number once it ends.
+
+    The connect is issued before the first suspension so the timeout covers
+    the handshake alone rather than time spent queued behind other probes. A
+    connect that times out gives ETIMEDOUT.
+    """
+    probe.setblocking(False)
+    error = probe.connect_ex(address)
+    if error not in IN_PROGRESS:
+        return error
+    writable = loop.create_future()
+    loop.add_writer(probe, wake, writable, True)
+    timer = loop.call_later(timeout, wake, writable, False)
+    try:
+        if not await writable:
+            return errno.ETIMEDOUT
+    finally:
+        timer.cancel()
+        loop.remove_writer(probe)
+    return probe.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+
+
+class Fingerprinter:
+    """Identify services on open ports while the sweep carries on.
+
+    Wraps an output and runs its own event loop in a thread. Open ports are
+    handed over as they are found, and every call on the wrapped output is
+    made from that thread, so a host is passed on only once all of its
+    ports have been identified.
+    """
+
+    def __init__(self, output, limit=BANNER_LIMIT, timeout=BANNER_TIMEOUT):
+        self.output = output
+        self.timeout = timeout
+        self.loop = asyncio.new_event_loop()
+        self.slots = asyncio.Semaphore(limit)
+        self.pending = {}
+        self.services = {}
+        self.closing = {}
+        self.tasks = set()
+        self.thread = threading.Thread(target=self.loop.run_forever,
+                                       daemon=True)
+        self.thread.start()
+
+    def found(self, host, port, elapsed):
+        """Start identifying an open port."""
+        self.loop.call_soon_threadsafe(self.start, host, port, elapsed)
+
+    def finished(self, target):
+        """Pass a host on once the ports still being identified are done."""
+        self.loop.call_soon_threadsafe(self.settle, target)
+
+    def close(self):
+        """Wait for every identification to end and stop the thread."""
+        asyncio.run_coroutine_threadsafe(self.drain(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def start(self, host, port, elapsed):
+        """Run an identification as a task on the loop."""
+        self.pending[host] = self.pending.get(host, 0) + 1
+        task = self.loop.create_task(self.identify(host, port, elapsed))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def identify(self, host, port, elapsed):
+        """Fingerprint one port and report it along with its service."""
+        async with self.slots:
+            service = await fingerprint(host, port, self.timeout)
+        self.services.setdefault(host, {})[port] = service
+        self.output.found(host, port, elapsed, service)
+        self.pending[host] -= 1
+        if not self.pending[host]:
+            del self.pending[host]
+            if host in self.closing:
+                self.settle(self.closing.pop(host))
+
+    def settle(self, target):
+        """Hand a finished host to the output unless ports are pending."""
+        if target.host in self.pending:
+            self.closing[target.host] = target
+        else:
+            target.services.update(self.services.pop(target.host, {}))
+            self.output.finished(target)
+
+    async def drain(self):
+        """Wait until no identification is left running."""
+        while self.tasks:
+            await asyncio.gather(*self.tasks)
+
+
+async def fingerprint(host, port, timeout):
+    """Guess the service on an open port, or give None if nothing answered.
+
+    Waits briefly for a greeting, then tries an HTTP request, and if that
+    draws no reply or a TLS alert, tries again inside a TLS handshake.
+    """
+    try:
+        reply = await converse(host, port, timeout)
+    except (OSError, asyncio.TimeoutError):
+        return None
+    if reply and not reply.startswith(b'\x15\x03'):
+        return classify(reply)
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    try:
+        reply = await converse(host, port, timeout, context)
+    except (OSError, asyncio.TimeoutError):
+        return classify(reply) if reply else None
+    service = classify(reply) if reply else None
+    if service is None or service.startswith('unknown'):
+        return 'tls'
+    return service.replace('http', 'https', 1)
+
+
+async def converse(host, port, timeout, context=None):
+    """Read the greeting of a server, or its answer to an HTTP request."""
+    name, version = untag(host)
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(name, port, ssl=context,
+                                family=VERSIONS.get(version, 0)), timeout)
+    try:
+        reply = await receive(reader, timeout)
+        if not reply:
+            writer.write(HTTP_PROBE)
+            reply = await receive(reader, timeout)
+        return reply
+    finally:
+        writer.close()
+
+
+async def receive(reader, timeout):
+    """Read what the server sends within the deadline."""
+    try:
+        return await asyncio.wait_for(reader.read(BANNER_SIZE), timeout)
+    except asyncio.TimeoutError:
+        return b''
+
+
+def classify(reply):
+    """Name a service from the first bytes it sent, with any version seen."""
+    for pattern, name in SIGNATURES:
+        match = re.search(pattern, reply, re.DOTALL | re.MULTILINE)
+        if match:
+            detail = match.group(1).decode(errors='replace').strip() \
+                if match.groups() else ''
+            return f'{name} {detail}' if detail else name
+    text = reply[:40].decode(errors='replace')
+    return f'unknown {text!r}'
+
+
+def wake(future, result=None):
+    """Resolve a future unless something else already has."""
+    if not future.done():
+        future.set_result(result)
+
+
+class TextWriter:
+    """Print the sorted open ports of each host once its sweep is finished."""
+
+    def __init__(self, file):
+        self.file = file
+
+    def found(self, host, port, elapsed, service=None):
+        """Wait for the whole host before showing anything."""
+
+    def finished(self, target):
+        """Show the report for a host, or why it could not be scanned."""
+        if target.error is None:
+            silent = []
+            if target.silent:
+                silent.append(f'{target.silent} more open|filtered')
+            print(f'Ports open on {label(target.host)}:',
+                  *format_ports(sorted(target.servers), target.services),
+                  *silent, sep='\n    ', file=self.file, flush=True)
+        else:
+            print(f'Could not scan {label(target.host)}: {target.error}',
+                  file=sys.stderr, flush=True)
+
+    def changed(self, target, opened, closed):
+        """Show the ports of a host that opened or closed, if any did."""
+        lines = []
+        if opened:
+            lines += (f'+ {line}'
+                      for line in format_ports(opened, target.services))
+        if closed:
+            lines += (f'- {line}' for line in format_ports(closed))
+        if lines:
+            print(f'Changes on {label(target.host)}:', *lines,
+                  sep='\n    ', file=self.file, flush=True)
+
+
+class RecordWriter:
+    """Stream one record per open port the moment it is found."""
+
+    def __init__(self, file):
+        self.file = file
+
+    def found(self, host, port, elapsed, service=None):
+        """Write a record for an open port."""
+        fields = record(host, port=port, state=OPEN, latency=round(elapsed, 6))
+        if service is not None:
+            fields['service'] = service
+        self.write(fields)
+
+    def finished(self, target):
+        """Write a record for a host that could not be scanned."""
+        if target.error is not None:
+            self.write(record(target.host, state='error',
+                              error=str(target.error)))
+
+    def changed(self, target, opened, closed):
+        """Write a record for each port of a host that opened or closed."""
+        for port in opened:
+            fields = record(target.host, port=port, state=OPEN)
+            if target.services.get(port) is not None:
+                fields['service'] = target.services[port]
+            self.write(fields)
+        for port in closed:
+            self.write(record(target.host, port=port, state=CLOSED))
+
+    def write(self, fields):
+        """Put a single record on the file and flush it right away."""
+        raise NotImplementedError
+
+
+class JsonWriter(RecordWriter):
+    """Stream results as JSON Lines."""
+
+    def write(self, fields):
+        """Put a record on the file as one line of JSON."""
+        print(json.dumps(fields), file=self.file, flush=True)
+
+
+class CsvWriter(RecordWriter):
+    """Stream results as CSV with a header row."""
+
+    def __init__(self, file):
+        super().__init__(file)
+        self.rows = csv.DictWriter(file, FIELDS)
+        self.rows.writeheader()
+
+    def write(self, fields):
+        """Put a record on the file as one CSV row."""
+        self.rows.writerow(fields)
+        self.file.flush()
+
+
+WRITERS = dict(text=TextWriter, jsonl=JsonWriter, csv=CsvWriter)
+
+
+def record(host, **fields):
+    """Stamp a result with the current time in UTC and the host's family."""
+    now = datetime.datetime.now(datetime.timezone.utc)
+    name, version = untag(host)
+    stamped = dict(time=now.isoformat(timespec='milliseconds'), host=name)
+    if version is not None:
+        stamped['family'] = version
+    return dict(stamped, **fields)
+
+
+def open_input(path):
+    """Open saved results for reading, with - standing for stdin."""
+    if path == '-':
+        return open(sys.stdin.fileno(), closefd=False)
+    return open(path, newline='')
+
+
+def summarize(file):
+    """Print the sorted report per host for streamed jsonl or csv results."""
+    first = file.readline()
+    lines = itertools.chain([first], file)
+    if first.lstrip().startswith('{'):
+        records = map(json.loads, filter(str.strip, lines))
+    else:
+        records = csv.DictReader(lines)
+    servers, errors = {}, {}
+    for fields in records:
+        host = fields['host']
+        if fields.get('family'):
+            host = f"ipv{fields['family']}:{host}"
+        if fields['state'] == OPEN:
+            services = servers.setdefault(host, {})
+            services[int(fields['port'])] = fields.get('service') or None
+        elif fields['state'] == 'error':
+            errors[host] = fields['error']
+    for host, services in servers.items():
+        print(f'Ports open on {label(host)}:',
+              *format_ports(sorted(services), services), sep='\n    ')
+    for host, error in errors.items():
+        print(f'Could not scan {label(host)}: {error}', file=sys.stderr)
+
+
+def format_ports(ports, services=None):
+    """Convert port numbers into strings and show all associated services.
+
+    Services identified from banners take the place of the registered names.
+    """
     if ports:
         for port in ports:
-            try:
-                service = socket.getservbyport(port)
-            except OSError:
-                service = '?'
+            service = services and services.get(port)
+            if not service:
+                try:
+                    service = socket.getservbyport(port)
+                except OSError:
+                    service = '?'
             yield f'{port:<5} = {service}'
     else:
         yield 'None'
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,195 @@
+#! /usr/bin/env python3
+import argparse
+import collections
+import json
+import os
+import random
+import selectors
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import portscanner
+
+PURPOSE = 'Measure portscanner engines against a farm of local listeners.'
+SCANNER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       'portscanner.py')
+HOST = '127.0.0.1'
+LISTENERS = 1 << 6
+BLACKHOLES = 1 << 3
+DELAY = 0.0
+BACKLOG = 1 << 7
+ROUNDS = 1
+TICK = 0.05
+HEADER = '{:<8} {:>8} {:>8} {:>9} {:>7} {:>6} {:>8} {:>7}'
+ROW = '{:<8} {:>8} {:>8.2f} {:>9.0f} {:>7} {:>6} {:>8.1f} {:>7.2f}'
+TITLES = ('engine', 'ports', 'seconds', 'ports/s', 'missed', 'extra',
+          'rss MiB', 'cpu s')
+
+Result = collections.namedtuple(
+    'Result', 'engine ports seconds rate missed extra rss cpu')
+
+
+def main():
+    """Start the farm, scan it with every engine asked for and report."""
+    parser = argparse.ArgumentParser(
+        description=PURPOSE,
+        epilog='Arguments not listed here are passed on to portscanner.')
+    parser.add_argument('--engine', action='append',
+                        choices=portscanner.ENGINES,
+                        help='engine to measure, may repeat (default: all)')
+    parser.add_argument('--listeners', type=int, default=LISTENERS,
+                        help='open ports to serve')
+    parser.add_argument('--blackholes', type=int, default=BLACKHOLES,
+                        help='ports whose handshakes are silently dropped')
+    parser.add_argument('--delay', type=float, default=DELAY,
+                        help='seconds each listener waits before accepting')
+    parser.add_argument('--backlog', type=int, default=BACKLOG,
+                        help='accept queue length of every listener')
+    parser.add_argument('--ports', type=int,
+                        help='probe only this many ports, farm ports first '
+                             '(default: all of them)')
+    parser.add_argument('--rounds', type=int, default=ROUNDS,
+                        help='scans per engine; the report shows each one')
+    parser.add_argument('--seed', type=int,
+                        help='seed for the order of the farm ports')
+    arguments, passed = parser.parse_known_args()
+    engines = arguments.engine or list(portscanner.ENGINES)
+    with Farm(arguments.listeners, arguments.blackholes, arguments.delay,
+              arguments.backlog) as farm:
+        first = farm.ports()
+        random.Random(arguments.seed).shuffle(first)
+        print(f'{len(farm.open)} listeners, {len(farm.blackholes)} '
+              f'blackholes on {HOST}', file=sys.stderr)
+        print(HEADER.format(*TITLES))
+        for _ in range(arguments.rounds):
+            for engine in engines:
+                result = run(engine, farm, first, arguments.ports, passed)
+                print(ROW.format(*result), flush=True)
+
+
+class Farm:
+    """Serve TCP listeners and blackholed ports on the loopback address.
+
+    Listeners answer handshakes and are accepted by one thread, after delay
+    seconds if one is set; a slow farm with a short backlog drops handshakes
+    once its accept queues fill. Blackholes stand in for filtered ports
+    without needing a firewall: each listens with no backlog and has its only
+    queue slot taken, so the kernel drops any further handshake.
+    """
+
+    def __init__(self, listeners, blackholes, delay=DELAY, backlog=BACKLOG):
+        self.count = listeners
+        self.holes = blackholes
+        self.delay = delay
+        self.backlog = backlog
+        self.open = []
+        self.blackholes = []
+        self.fillers = []
+        self.selector = selectors.DefaultSelector()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exception):
+        self.stop()
+
+    def start(self):
+        """Open every socket and start accepting connections."""
+        for _ in range(self.count):
+            server = listen(self.backlog)
+            server.setblocking(False)
+            self.selector.register(server, selectors.EVENT_READ)
+            self.open.append(server)
+        for _ in range(self.holes):
+            server = listen(0)
+            self.fillers.append(socket.create_connection(
+                server.getsockname()))
+            self.blackholes.append(server)
+        self.thread.start()
+
+    def stop(self):
+        """Stop accepting and close every socket."""
+        self.stopping.set()
+        self.thread.join()
+        self.selector.close()
+        for each in self.open + self.blackholes + self.fillers:
+            each.close()
+
+    def ports(self):
+        """List the port numbers of the listeners and the blackholes."""
+        return [server.getsockname()[1]
+                for server in self.open + self.blackholes]
+
+    def serve(self):
+        """Accept and drop connections, each delay seconds after it arrives."""
+        pending = collections.deque()
+        while not self.stopping.is_set():
+            timeout = TICK
+            if pending:
+                timeout = min(TICK, max(0.0, pending[0][0] - time.monotonic()))
+            for key, _ in self.selector.select(timeout):
+                self.selector.unregister(key.fileobj)
+                pending.append((time.monotonic() + self.delay, key.fileobj))
+            while pending and pending[0][0] <= time.monotonic():
+                _, server = pending.popleft()
+                drain(server)
+                self.selector.register(server, selectors.EVENT_READ)
+
+
+def listen(backlog):
+    """Open a listening socket on a free loopback port."""
+    server = socket.socket()
+    server.bind((HOST, 0))
+    server.listen(backlog)
+    return server
+
+
+def drain(server):
+    """Accept and close every connection queued on server."""
+    while True:
+        try:
+            connection, _ = server.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        connection.close()
+
+
+def run(engine, farm, first, count, passed):
+    """Scan the farm with one engine and measure how it went.
+
+    Missed counts listeners the scan did not report and extra counts ports
+    it reported that are not listeners. Peak RSS is that of the largest
+    process the scan ran, pool workers included, while CPU time is summed
+    over all of them.
+    """
+    command = [sys.executable, SCANNER, '--engine', engine, '--format',
+               'jsonl', '--order', 'numeric', '--first',
+               ','.join(map(str, first))]
+    if count is not None:
+        command += ['--top', str(count)]
+    command += passed + [HOST]
+    started = time.perf_counter()
+    scan = subprocess.Popen(command, stdout=subprocess.PIPE)
+    output = scan.stdout.read()
+    _, status, usage = os.wait4(scan.pid, 0)
+    seconds = time.perf_counter() - started
+    scan.returncode = os.waitstatus_to_exitcode(status)
+    scan.stdout.close()
+    if scan.returncode:
+        raise subprocess.CalledProcessError(scan.returncode, command)
+    found = {json.loads(line)['port'] for line in output.splitlines()}
+    expected = {server.getsockname()[1] for server in farm.open}
+    ports = len(portscanner.PORTS) if count is None else count
+    return Result(engine, ports, seconds, ports / seconds,
+                  len(expected - found), len(found - expected),
+                  usage.ru_maxrss / 1024, usage.ru_utime + usage.ru_stime)
+
+
+if __name__ == '__main__':
+    main()